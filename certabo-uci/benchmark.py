@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+#
+# offline benchmarks of the frame decoding and move detection paths, using
+# synthetic sensor frames instead of a board
+#
+# python3 benchmark.py --games 5 --noise 0.01 --output results.json
+#
+# --startup RUNS only times the engine's start instead, from launching
+# certabo-uci.py to its uciok, as a GUI sees it.
+#
+# --calibration renders the frames with the codes of a real board, e.g.
+# ~/.local/share/GUI/calibration-com1.cal, so that the distances between its
+# codes drive the near-miss matching and the filters.
+#
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+import chess
+import chess.pgn
+
+import codes
+import cellfilter
+import movedetect
+import synthframes
+
+
+def per_call(statement):
+    """ seconds per call of statement, timed for about 0.2s or more """
+    timer = timeit.Timer(statement)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def micro_benchmarks(profile, rnd):
+    """ microseconds per call of the single steps of the frame path """
+    board = chess.Board()
+    for move in synthframes.random_game(seed=rnd.random(), max_plies=20):
+        board.push(move)
+    after = board.copy()
+    after.push(rnd.choice(list(after.legal_moves)))
+    frame = profile.render(after)
+    samples = [profile.render(after, rnd, noise=0.01) for _ in range(3)]
+    names = [codes.cell_name(cell) for cell in cellfilter.frame_cells(frame)]
+    fen = codes.usb_data_to_FEN(frame)
+    board_key, usb_key = codes.placement_key(board), codes.names_to_placement(names)
+    diffmap = codes.placement_diff(board_key, usb_key)
+    history = cellfilter.HistoryFilter(3)
+    adaptive = cellfilter.AdaptiveCellFilter()
+    decoder = codes.DeltaDecoder()
+
+    def filter_push(f):
+        f.push(samples[0])
+        f.push(frame)
+
+    def decode():
+        decoder.reset()
+        decoder.update(frame)
+        decoder.placement()
+
+    steps = {
+        "statistic_processing": lambda: codes.statistic_processing(samples, False),
+        "usb_data_to_FEN": lambda: codes.usb_data_to_FEN(frame),
+        "delta_decode_placement": decode,
+        "history_filter_push": lambda: filter_push(history),
+        "adaptive_filter_push": lambda: filter_push(adaptive),
+        "get_moves": lambda: codes.get_moves(board, fen),
+        "placement_diff": lambda: codes.placement_diff(board_key, usb_key),
+        "squareset2ledbytes": lambda: codes.squareset2ledbytes(diffmap),
+        "successor_index_build": lambda: movedetect.SuccessorIndex(board).thread.join(),
+    }
+    return {name: round(per_call(step) * 1e6, 3) for name, step in steps.items()}
+
+
+class Pipeline:
+    """ what certabo-uci.py does with a frame while the user moves for both sides """
+
+    def __init__(self, filter_name="adaptive", use_index=True):
+        if filter_name == "majority":
+            self.filter = cellfilter.HistoryFilter(3)
+        else:
+            self.filter = cellfilter.AdaptiveCellFilter()
+        self.decoder = codes.DeltaDecoder()
+        self.board = chess.Board()
+        self.use_index = use_index
+        self.successors = self.index()
+
+    def index(self):
+        if not self.use_index:
+            return None
+        index = movedetect.SuccessorIndex(self.board)
+        # in the engine the index is built while the user thinks
+        index.ready.wait()
+        return index
+
+    def feed(self, usb_data):
+        """ returns the move recognised in this frame, None if there is none """
+        usb_data = self.filter.push(usb_data)
+        if usb_data is None or not self.decoder.update(usb_data):
+            return None
+        placement = self.decoder.placement()
+        if placement is None or not codes.placement_diff(codes.placement_key(self.board), placement):
+            return None
+        try:
+            moves = movedetect.find_moves(self.successors, self.board, placement)
+        except codes.InvalidMove:
+            return None
+        if len(moves) != 1:
+            return None
+        move = chess.Move.from_uci(moves[0])
+        self.board.push(move)
+        return move
+
+
+def replay(profile, games, args, rnd):
+    """ feed the frames of games through a Pipeline, returns throughput and per move latency """
+    handled = 0
+    busy = 0.0
+    latencies = []
+    frame_latencies = []
+    missed = 0
+    for moves in games:
+        pipeline = Pipeline(args.filter, not args.no_index)
+        shown = None
+        frames = synthframes.game_frames(profile, moves, frames_per_state=args.frames_per_state,
+                                         rnd=rnd, noise=args.noise, bit_noise=args.bit_noise)
+        for frame, move in frames:
+            if move is not None:
+                if shown is not None:
+                    missed += 1
+                shown = (move, time.perf_counter(), handled)
+            started = time.perf_counter()
+            recognised = pipeline.feed(frame)
+            finished = time.perf_counter()
+            busy += finished - started
+            handled += 1
+            if recognised is not None and shown is not None:
+                if recognised == shown[0]:
+                    latencies.append(finished - shown[1])
+                    frame_latencies.append(handled - shown[2])
+                shown = None
+                if not args.no_index:
+                    pipeline.successors = pipeline.index()
+        if shown is not None:
+            missed += 1
+    latencies.sort()
+
+    def percentile(values, fraction):
+        return values[min(int(fraction * len(values)), len(values) - 1)] if values else None
+
+    return {
+        "frames": handled,
+        "frames_per_second": round(handled / busy, 1) if busy else None,
+        "moves_recognised": len(latencies),
+        "moves_missed": missed,
+        "move_latency_ms": {
+            f"p{p}": round(percentile(latencies, p / 100) * 1000, 3) if latencies else None
+            for p in (50, 95, 99)
+        },
+        "move_latency_frames_mean": round(sum(frame_latencies) / len(frame_latencies), 3) if frame_latencies else None,
+    }
+
+
+def load_games(args):
+    if args.pgn is None:
+        return [synthframes.random_game(seed=args.seed + n, max_plies=args.plies) for n in range(args.games)]
+    games = []
+    with open(args.pgn) as pgn:
+        while len(games) < args.games:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            games.append(list(game.mainline_moves())[:args.plies])
+    return games
+
+
+def startup(script, runs):
+    """ milliseconds from launching script and sending uci until it answers uciok, over fresh processes """
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        engine = subprocess.Popen([sys.executable, script, "--port", os.devnull], stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            engine.stdin.write("uci\n")
+            engine.stdin.flush()
+            for line in engine.stdout:
+                if line.strip() == "uciok":
+                    break
+            else:
+                raise RuntimeError(f"{script} exited without answering uciok")
+            times.append(time.perf_counter() - started)
+            engine.stdin.write("quit\n")
+            engine.stdin.flush()
+            engine.wait(10)
+        finally:
+            if engine.poll() is None:
+                engine.kill()
+                engine.wait()
+    return {
+        "runs": runs,
+        "median_ms": round(statistics.median(times) * 1000, 1),
+        "min_ms": round(min(times) * 1000, 1),
+        "max_ms": round(max(times) * 1000, 1),
+    }
+
+
+def load_profile(args, parser):
+    """ the SensorProfile frames are rendered with, installed as the calibration of codes.py """
+    if args.calibration is None:
+        profile = synthframes.SensorProfile.random(args.seed)
+    else:
+        try:
+            with open(args.calibration, "rb") as f:
+                lists = codes.unpack_calibration(f.read())
+        except (IOError, OSError, ValueError) as e:
+            parser.error(f"cannot load {args.calibration}: {e}")
+        missing = [name for name, cells in zip(codes.calibration_pieces, lists) if not cells]
+        if missing:
+            parser.error(f"{args.calibration} has no codes for {', '.join(missing)}")
+        profile = synthframes.SensorProfile(lists)
+    profile.install()
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmarks of frame decoding and move detection")
+    parser.add_argument("--games", type=int, default=5, help="number of games to replay")
+    parser.add_argument("--plies", type=int, default=80, help="maximum plies per game")
+    parser.add_argument("--pgn", help="replay the games of this PGN file instead of random ones")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--calibration", metavar="FILE",
+                        help="render frames with the codes of this calibration file instead of random ones")
+    parser.add_argument("--noise", type=float, default=0.0, help="chance of a cell reading a random code")
+    parser.add_argument("--bit-noise", type=float, default=0.0, help="chance of a piece code with a flipped bit")
+    parser.add_argument("--frames-per-state", type=int, default=3, help="frames showing each position")
+    parser.add_argument("--filter", choices=("adaptive", "majority"), default="adaptive")
+    parser.add_argument("--no-index", action="store_true", help="detect moves without the successor index")
+    parser.add_argument("--skip-micro", action="store_true", help="only replay games")
+    parser.add_argument("--startup", type=int, metavar="RUNS",
+                        help="only time the engine from launch to uciok, over RUNS runs")
+    parser.add_argument("--engine", metavar="SCRIPT",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "certabo-uci.py"),
+                        help="engine timed by --startup, e.g. certabo-uci.py of an older checkout")
+    parser.add_argument("--output", help="write the results as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+    }
+    if args.startup is not None:
+        if args.startup < 1:
+            parser.error("--startup needs at least one run")
+        results["startup"] = startup(args.engine, args.startup)
+    else:
+        rnd = random.Random(args.seed)
+        profile = load_profile(args, parser)
+        if not args.skip_micro:
+            results["micro_us"] = micro_benchmarks(profile, rnd)
+        results["replay"] = replay(profile, load_games(args), args, rnd)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
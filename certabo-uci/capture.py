@@ -0,0 +1,117 @@
+#
+# recording of the sensor frames the board sends, see replay.py
+#
+# A capture file starts with a header: "CCAP", version (uint16) and the
+# wall clock time of the recording start (double), all little endian.
+# Every frame follows as
+#
+#   varint  microseconds since the previous frame (since the start for the first)
+#   uint8   number of cells that differ from the previous frame (all empty before the first)
+#   per differing cell: uint8 cell number, 5 bytes cell code
+#
+# so a board that sends the same frame over and over costs two bytes per frame.
+#
+
+import struct
+import time
+
+MAGIC = b"CCAP"
+VERSION = 1
+header = struct.Struct("<4sHd")
+empty_frame = bytes(320)
+
+
+def encode_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(data, offset):
+    """ value and offset after it """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_frame(previous, frame):
+    changed = [n_cell for n_cell in range(64) if frame[n_cell * 5:n_cell * 5 + 5] != previous[n_cell * 5:n_cell * 5 + 5]]
+    data = bytearray([len(changed)])
+    for n_cell in changed:
+        data.append(n_cell)
+        data += frame[n_cell * 5:n_cell * 5 + 5]
+    return bytes(data)
+
+
+class CaptureWriter:
+    """ appends frames with their time.monotonic() arrival time to a capture file """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(header.pack(MAGIC, VERSION, time.time()))
+        self.previous = empty_frame
+        self.last_time = None
+        self.frames = 0
+
+    def write(self, frame, received):
+        if self.file is None:
+            return
+        if self.last_time is None:
+            self.last_time = received
+        delay = max(int(round((received - self.last_time) * 1e6)), 0)
+        # advance by what was written, so rounding errors don't add up
+        self.last_time += delay / 1e6
+        self.file.write(encode_varint(delay) + encode_frame(self.previous, frame))
+        self.previous = bytes(frame)
+        self.frames += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path):
+    """ (seconds since the first frame, frame as 320 bytes) of every frame in a capture file """
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        magic, version, _ = header.unpack_from(data)
+    except struct.error:
+        raise ValueError(f"{path} is too short for a capture file")
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a capture file")
+    if version != VERSION:
+        raise ValueError(f"{path} has unsupported capture version {version}")
+    frame = bytearray(empty_frame)
+    offset = header.size
+    elapsed = 0
+    try:
+        while offset < len(data):
+            delay, offset = decode_varint(data, offset)
+            elapsed += delay
+            changed = data[offset]
+            offset += 1
+            for _ in range(changed):
+                if offset + 6 > len(data):
+                    return  # the recording was cut off in the middle of a frame
+                n_cell = data[offset]
+                frame[n_cell * 5:n_cell * 5 + 5] = data[offset + 1:offset + 6]
+                offset += 6
+            yield elapsed / 1e6, bytes(frame)
+    except IndexError:
+        return  # the recording was cut off in the middle of a frame
+
+
+def frame_line(frame):
+    """ a frame as the board sends it """
+    return b":" + b" ".join(b"%d" % value for value in frame) + b" \r\n"
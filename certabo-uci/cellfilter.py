@@ -0,0 +1,245 @@
+#
+# noise filters for the stream of sensor frames
+#
+
+import collections
+
+import codes
+
+empty_code = codes.empty_code
+
+
+def frame_cells(usb_data):
+    return [tuple(usb_data[i:i + 5]) for i in range(0, 320, 5)]
+
+
+class HistoryFilter:
+    """
+    Per-cell majority vote over the last `depth` frames.
+
+    Works like codes.statistic_processing() on a sliding window, but keeps a
+    code counter per cell so a new frame only costs the cells whose code
+    entered or left the window. A code close to a calibrated one votes for
+    that one, other unknown codes get no vote and a cell without any known
+    code in the window reads as empty. On a tie the current winner stays.
+    """
+
+    def __init__(self, depth=3):
+        self.depth = depth
+        self.reset()
+
+    def reset(self):
+        self.frames = collections.deque()
+        self.history = collections.deque()
+        self.counters = [{} for _ in range(64)]
+        self.winners = [empty_code] * 64
+        self.index = codes.piece_index
+        self.result = None
+
+    def push(self, usb_data):
+        """
+        Add a frame and return the filtered frame (320 values), or None while
+        fewer than `depth` frames have been seen.
+        """
+        if self.index is not codes.piece_index:
+            # calibration changed, recount the window against the new codes
+            frames = self.frames
+            self.reset()
+            for cells in frames:
+                self.add(cells)
+        self.add(frame_cells(usb_data))
+        if len(self.history) < self.depth:
+            return None
+        if self.result is None:
+            self.result = [value for cell in self.winners for value in cell]
+        return self.result
+
+    def add(self, cells):
+        if len(self.frames) >= self.depth:
+            self.frames.popleft()
+            evicted = self.history.popleft()
+        else:
+            evicted = None
+        self.frames.append(cells)
+        cells = [codes.canonical_code(cell) for cell in cells]
+        self.history.append(cells)
+        for n_cell, cell in enumerate(cells):
+            old = evicted[n_cell] if evicted is not None else None
+            if cell == old:
+                continue
+            counter = self.counters[n_cell]
+            if cell is not None:
+                counter[cell] = counter.get(cell, 0) + 1
+            if old is not None:
+                counter[old] -= 1
+                if not counter[old]:
+                    del counter[old]
+            self.update_winner(n_cell, cell, old)
+
+    def update_winner(self, n_cell, added, removed):
+        counter = self.counters[n_cell]
+        winner = self.winners[n_cell]
+        votes = counter.get(winner, 0)
+        if added is not None and counter[added] > votes:
+            winner = added
+        elif removed == winner or not votes:
+            best = max(counter.values(), default=0)
+            if votes < best:
+                winner = max(counter, key=counter.get)
+            elif not votes:
+                winner = empty_code
+        if winner != self.winners[n_cell]:
+            self.winners[n_cell] = winner
+            self.result = None
+
+
+class AdaptiveCellFilter:
+    """
+    Per-cell filter that commits a new code once enough readings in a row
+    agree on it. Every cell keeps an estimate of its flicker rate, the share
+    of readings showing a code that is gone again before it was committed,
+    as a moving average over about `1 / alpha` frames. A code is committed
+    after k agreeing readings, k being the smallest number >= min_run for
+    which rate ** k <= 1 - confidence (at most max_run), so steady cells
+    commit on the first reading and flickering ones wait for more.
+
+    Readings are mapped to calibrated codes by codes.canonical_code(), unknown
+    readings are ignored.
+    """
+
+    def __init__(self, min_run=1, max_run=5, confidence=0.99, alpha=0.05):
+        self.min_run = min_run
+        self.max_run = max_run
+        self.confidence = confidence
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.index = codes.piece_index
+        self.usb_data = None
+        self.frame = 0
+        self.committed = [empty_code] * 64
+        self.candidates = [None] * 64
+        # last raw reading of every cell and the code it stands for
+        self.readings = [None] * 64
+        self.canonical = [None] * 64
+        self.runs = [0] * 64
+        self.previous = [empty_code] * 64
+        self.commit_frames = [0] * 64
+        self.rates = [0.0] * 64
+        self.rate_frames = [0] * 64
+        self.pending = False
+        self.result = None
+
+    def push(self, usb_data):
+        """ add a frame and return the filtered frame (320 values) """
+        if self.index is not codes.piece_index:
+            self.reset()
+        self.frame += 1
+        if usb_data == self.usb_data and not self.pending:
+            return self.result
+        self.usb_data = usb_data
+        self.pending = False
+        for n_cell, cell in enumerate(frame_cells(usb_data)):
+            if cell != self.readings[n_cell]:
+                self.readings[n_cell] = cell
+                self.canonical[n_cell] = codes.canonical_code(cell)
+            cell = self.canonical[n_cell]
+            # a near miss of the committed code is no change either
+            if cell != self.committed[n_cell] or self.candidates[n_cell] is not None:
+                self.read(n_cell, cell)
+        if self.result is None:
+            self.result = [value for cell in self.committed for value in cell]
+        return self.result
+
+    def read(self, n_cell, cell):
+        if cell is None:
+            # unknown readings are never committed, they neither count nor break a run
+            if self.candidates[n_cell] is not None:
+                self.pending = True
+            return
+        if cell == self.committed[n_cell]:
+            if self.candidates[n_cell] is not None:
+                # the new code did not last
+                self.candidates[n_cell] = None
+                self.flickered(n_cell)
+        elif cell == self.candidates[n_cell]:
+            self.runs[n_cell] += 1
+        else:
+            if self.candidates[n_cell] is not None:
+                self.flickered(n_cell)
+            self.candidates[n_cell] = cell
+            self.runs[n_cell] = 1
+        if self.candidates[n_cell] is None:
+            return
+        cell = self.candidates[n_cell]
+        run = self.required_run(n_cell)
+        if cell != empty_code and self.committed[n_cell] != empty_code:
+            # a piece is replaced by lifting it first, a direct change is suspicious
+            run += 1
+        if self.runs[n_cell] >= run:
+            if cell == self.previous[n_cell] and self.frame - self.commit_frames[n_cell] <= self.max_run:
+                # back to what it was right before, the last commit was flicker
+                self.flickered(n_cell)
+            self.previous[n_cell] = self.committed[n_cell]
+            self.committed[n_cell] = cell
+            self.commit_frames[n_cell] = self.frame
+            self.candidates[n_cell] = None
+            self.result = None
+        else:
+            self.pending = True
+
+    def rate(self, n_cell):
+        """ flicker rate of a cell, decayed to the current frame """
+        return self.rates[n_cell] * (1 - self.alpha) ** (self.frame - self.rate_frames[n_cell])
+
+    def required_run(self, n_cell):
+        rate = self.rate(n_cell)
+        run = self.min_run
+        while run < self.max_run and rate ** run > 1 - self.confidence:
+            run += 1
+        return run
+
+    def flickered(self, n_cell):
+        self.rates[n_cell] = self.rate(n_cell) + self.alpha
+        self.rate_frames[n_cell] = self.frame
+
+
+class CalibrationEstimator:
+    """
+    Per-cell code statistics over calibration samples, updated as each
+    sample arrives. Calibration can finish as soon as every cell's most
+    frequent code makes up `confidence` of at least `min_samples` samples,
+    noisy sensors get up to `max_samples`. The codes are then voted from
+    `samples` by statistic_processing_for_calibration() of codes or npcodes.
+    """
+
+    def __init__(self, min_samples=5, max_samples=45, confidence=0.75):
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.confidence = confidence
+        self.reset()
+
+    def reset(self):
+        self.samples = []
+        self.counters = [{} for _ in range(64)]
+        self.winners = [0] * 64  # votes for the most frequent code of each cell
+
+    def add(self, usb_data):
+        """ add a sample, returns True once enough samples have been collected """
+        self.samples.append(usb_data)
+        for n_cell, cell in enumerate(frame_cells(usb_data)):
+            counter = self.counters[n_cell]
+            votes = counter.get(cell, 0) + 1
+            counter[cell] = votes
+            if votes > self.winners[n_cell]:
+                self.winners[n_cell] = votes
+        return self.done()
+
+    def done(self):
+        n_samples = len(self.samples)
+        if n_samples >= self.max_samples:
+            return True
+        if n_samples < self.min_samples:
+            return False
+        return min(self.winners) >= self.confidence * n_samples
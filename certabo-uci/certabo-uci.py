@@ -6,70 +6,103 @@
 
 from __future__ import print_function
 from __future__ import division
-import importlib
-import re
+import importlib.util
 import sys
 import time
 import logging
 import logging.handlers
-import traceback
 import os
 import argparse
-import subprocess
-import time as tt
 import threading
+import atexit
 import queue
-import serial
-import fcntl
 
-import serial.tools.list_ports
+import serialio
+import leds
+import latency
+import capture
 
-from socket import *
-from select import *
+import constants
+from utils import port2number, find_port
 
-import chess.pgn
-import chess
+# only what is needed to answer the uci handshake is imported above, the
+# engine's modules follow with import_engine_modules() and the rest
+# (pyserial, numpy, asyncio, the profiler) is imported on first use
 
-from random import shuffle
+def import_engine_modules():
+    global chess, codes, cellfilter, movedetect
+    import chess
+    import codes
+    import cellfilter
+    import movedetect
 
-import codes
-
-from utils import port2number, port2udp, find_port, get_engine_list, get_book_list, coords_in
-from constants import CERTABO_SAVE_PATH, CERTABO_DATA_PATH, MAX_DEPTH_DEFAULT
-
-DEBUG = True
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
 
 logger = logging.getLogger()
-if DEBUG:
-    logger.setLevel(logging.DEBUG)
-else:
-    logger.setLevel(logging.INFO)
-
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(module)s %(message)s')
-
-filehandler = logging.handlers.TimedRotatingFileHandler(
-    os.path.join(CERTABO_DATA_PATH, "certabo-uci.log"), backupCount=12
-)
-filehandler.setFormatter(formatter)
-logger.addHandler(filehandler)
+logger.setLevel(logging.INFO)
+
+# records are written to the file by a background thread, so a slow disk
+# doesn't hold up the threads that log; until start_log_file() they wait
+# in the queue
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = None
+
+def start_log_file():
+    """ create the data directories and start writing the log, deferred until the first command is answered """
+    global log_listener
+    if log_listener is not None:
+        return
+    for d in (constants.CERTABO_SAVE_PATH, constants.CERTABO_DATA_PATH):
+        try:
+            os.makedirs(d)
+        except OSError:
+            pass
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(module)s %(message)s')
+    filehandler = logging.handlers.TimedRotatingFileHandler(
+        os.path.join(constants.CERTABO_DATA_PATH, "certabo-uci.log"), backupCount=12
+    )
+    filehandler.setFormatter(formatter)
+    log_listener = logging.handlers.QueueListener(log_queue, filehandler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
 # log unhandled exceptions to the log file
 def my_excepthook(excType, excValue, traceback, logger=logger):
+    start_log_file()
     logger.error("Uncaught exception",
                  exc_info=(excType, excValue, traceback))
 sys.excepthook = my_excepthook
 
 logging.info("certabi-uci.py startup")
 
-for d in (CERTABO_SAVE_PATH, CERTABO_DATA_PATH):
-    try:
-        os.makedirs(d)
-    except OSError:
-        pass
-
 parser = argparse.ArgumentParser()
 parser.add_argument("--port")
+parser.add_argument("--calibration-vote", choices=("auto", "python", "numpy"), default="auto",
+                    help="implementation of the vote over the calibration samples, auto uses numpy when it is installed")
+parser.add_argument("--filter", choices=("adaptive", "majority"), default="adaptive",
+                    help="sensor noise filter, majority votes over the last 3 frames for every cell")
+parser.add_argument("--record", metavar="FILE",
+                    help="record the sensor frames to FILE, see replay.py")
+parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO",
+                    help="level of the messages written to certabo-uci.log")
+parser.add_argument("--asyncio", action="store_true",
+                    help="handle UCI commands and the board on a single asyncio event loop")
 args = parser.parse_args()
+logger.setLevel(args.log_level)
+
+numpy_available = importlib.util.find_spec("numpy") is not None
+if args.calibration_vote == "numpy" and not numpy_available:
+    parser.error("--calibration-vote numpy requires numpy to be installed")
+use_numpy = args.calibration_vote != "python" and numpy_available
+logging.info(f'using {"npcodes" if use_numpy else "codes"} for the calibration vote')
+
+def calibration_vote():
+    """ module providing statistic_processing_for_calibration(), npcodes is imported on first use """
+    if use_numpy:
+        import npcodes
+        return npcodes
+    return codes
 
 portname = 'auto'
 if args.port is not None:
@@ -77,12 +110,35 @@ if args.port is not None:
 port = port2number(portname)
 
 stack = queue.Queue()
-serial_in = queue.Queue()
-serial_out = queue.Queue()
+# frames that arrive faster than they are handled are dropped, oldest first
+serial_in = serialio.FrameChannel(maxlen=3)
+# set when a UCI command or a frame arrived, the threaded main loop waits for it
+inbox = threading.Event()
+recorder = None
+if args.record is not None:
+    recorder = capture.CaptureWriter(args.record)
+    atexit.register(recorder.close)
+
+def frame_received(frame, received):
+    if recorder is not None:
+        recorder.write(frame, received)
+    serial_in.put((frame, received, time.monotonic()))
+    inbox.set()
+
+serial_transport = serialio.SerialTransport(frame_received)
+led_output = leds.LedOutput(serial_transport.send)
+# the main loop sets its wakeup and runs it from a timer
+led_animator = leds.LedAnimator(led_output)
+
+# shown while the board is calibrated
+calibration_blink = [
+    (b'\xff\xff\x00\x00\x00\x00\xff\xff', 0.25),
+    (leds.leds_off, 0.25),
+]
 
 class ucireader(threading.Thread):
     def __init__ (self, device='sys.stdin'):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='ucireader')
         self.device = device
 
     def run(self):
@@ -90,20 +146,39 @@ class ucireader(threading.Thread):
             try:
                 line = input() # we ignore the specific device and just read via input() from stdin
                 stack.put(line)
+                inbox.set()
                 if line == "quit":
                     break
             except EOFError:
                 # we quit
                 stack.put('quit')
+                inbox.set()
                 break
 
-inputthread = ucireader('sys.stdin')
-inputthread.daemon = True
-inputthread.start()
+def open_board(device):
+    """ open and lock the board's serial port, returns None if no port was found """
+    if device == 'auto':
+        logging.info(f'Auto-detecting serial port')
+        serialport = find_port()
+    else:
+        serialport = device
+    if serialport is None:
+        logging.info(f'No port found, retrying')
+        return None
+    logging.info(f'Opening serial port {serialport}')
+    import serial
+    uart = serial.Serial(serialport, 38400, timeout=2.5)  # 0-COM1, 1-COM2 / speed /
+    if os.name == 'posix':
+        import fcntl
+        logging.debug('Attempting to lock %s', serialport)
+        fcntl.flock(uart.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    logging.debug('Flushing input on %s', serialport)
+    uart.flushInput()
+    return uart
 
 class serialreader(threading.Thread):
     def __init__ (self, device='auto'):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='serialreader')
         self.device = device
         self.connected = False
 
@@ -111,286 +186,542 @@ class serialreader(threading.Thread):
         while True:
             if not self.connected:
                 try:
-                    if self.device == 'auto':
-                        logging.info(f'Auto-detecting serial port')
-                        serialport = find_port()
-                    else:
-                        serialport = self.device
-                    if serialport is None:
-                        logging.info(f'No port found, retrying')
+                    uart = open_board(self.device)
+                    if uart is None:
                         time.sleep(1)
                         continue
-                    logging.info(f'Opening serial port {serialport}')
-                    uart = serial.Serial(serialport, 38400, timeout=2.5)  # 0-COM1, 1-COM2 / speed /
-                    if os.name == 'posix':
-                        logging.debug(f'Attempting to lock {serialport}')
-                        fcntl.flock(uart.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    logging.debug(f'Flushing input on {serialport}')
-                    uart.flushInput()
+                    serial_transport.attach(uart)
+                    led_output.invalidate()
                     self.connected = True
                 except Exception as e:
-                    logging.info(f'ERROR: Cannot open serial port {serialport}: {str(e)}')
+                    logging.info(f'ERROR: Cannot open serial port {self.device}: {str(e)}')
                     self.connected = False
                     time.sleep(0.1)
             else:
                 try:
-                    while uart.inWaiting():
-                        # logging.debug(f'serial data pending')
-                        message = uart.readline().decode("ascii")
-                        message = message[1: -3]
-                        #if DEBUG:
-                        #    print(len(message.split(" ")), "numbers")
-                        if len(message.split(" ")) == 320:  # 64*5
-                            serial_in.put(message)
-                        message = ""
-                    time.sleep(0.001)
-                    if not serial_out.empty():
-                        data = serial_out.get()
-                        serial_out.task_done()
-                        logging.debug(f'Sending to serial: {data}')
-                        uart.write(data)
+                    # sleeps until the board sends data or LED output is queued
+                    serial_transport.poll(1.0)
                 except Exception as e:
                     logging.info(f'Exception during serial communication: {str(e)}')
+                    serial_transport.detach()
                     self.connected = False
 
-def main():
-    global portname
-    new_usb_data = False
-    usb_data_exist = False
-    serial_thread_spawned = False
-
-    def send_leds(message=b'\x00' * 8):
-        serial_out.put(message)
-
-    chessboard = chess.Board()
-    tmp_chessboard = chess.Board()
-    move = []
-    starting_position = chess.STARTING_FEN
-    rotate180 = False
-    mystate = "init"
-
-    calibration = False
-    new_setup = True
-    calibration_samples_counter = 0
-    calibration_samples = []
-
-    usb_data_history_depth = 3
-    usb_data_history = list(range(usb_data_history_depth))
-    usb_data_history_filled = False
-    usb_data_history_i = 0
-    move_detect_tries = 0
-    move_detect_max_tries = 3
-
-    def output(line):
-        logging.debug(f'<<< {line} ')
-        print(line)
-        sys.stdout.flush()
+def output(line):
+    logging.debug('<<< %s ', line)
+    print(line)
+    sys.stdout.flush()
 
-    while True:
-        ucicommand = ""
-        time.sleep(0.001)
+def send_leds(message=leds.leds_off):
+    # unchanged LED states are not sent again, LED hints stop animations
+    led_animator.show(message)
+
+class ledtimer(threading.Thread):
+    """ plays the LED animations, sleeping until the next message is due """
+    def __init__ (self):
+        threading.Thread.__init__(self, name='ledtimer')
+        self.wake = threading.Event()
+        led_animator.wakeup = self.wake.set
 
-        if not serial_in.empty():
+    def run(self):
+        while True:
+            due = led_animator.run_due()
+            self.wake.wait(None if due is None else max(due - time.monotonic(), 0))
+            self.wake.clear()
+
+def uci_handshake():
+    """ answer the uci command, needs none of the engine's modules """
+    output('id name CERTABO physical board')
+    output('id author Harald Klein (based on work from Thomas Ahle & Contributors)')
+    output('option name Calibrate type check default false')
+    output('option name AddPiece type check default false')
+    output('option name Rotate type check default false')
+    output('option name Port type string default auto')
+    output('option name LatencyStats type button')
+    output('option name Profile type combo default stop var start var stop')
+    output(f'option name LogLevel type combo default {logging.getLevelName(logger.level)} ' + ' '.join(f'var {level}' for level in LOG_LEVELS))
+    output(f'option name MatchRadius type spin default {constants.MATCH_RADIUS_DEFAULT} min 0 max 8')
+    output('uciok')
+
+class certaboengine:
+    """
+    Session state, fed with UCI commands and sensor frames by either the
+    threaded main loop or the asyncio one.
+
+    start_board(portname) connects to the board; LED animations are played by
+    led_animator, on a timer of the main loop.
+    """
+
+    def __init__(self, start_board):
+        self.start_board = start_board
+        self.portname = portname
+        self.board_started = False
+
+        self.chessboard = chess.Board()
+        self.tmp_chessboard = chess.Board()
+        self.rotate180 = False
+        self.mystate = "init"
+
+        self.calibration = False
+        self.new_setup = True
+        self.calibration_samples = cellfilter.CalibrationEstimator()
+        self.calibration_animation = None
+
+        self.usb_data_history_depth = 3
+        if args.filter == "majority":
+            self.usb_data_filter = cellfilter.HistoryFilter(self.usb_data_history_depth)
+        else:
+            self.usb_data_filter = cellfilter.AdaptiveCellFilter()
+        self.usb_data_decoder = codes.DeltaDecoder()
+        self.last_board_key = None
+        self.move_detect_tries = 0
+        self.move_detect_max_tries = 3
+        self.frames_dropped = 0
+        self.lines_malformed = 0
+        self.latency = latency.LatencyStats()
+        self.profiler = None
+        self.frame_received = None
+        # successor indexes of chessboard and of the last position command
+        self.successors = None
+        self.next_successors = None
+        self.memo = None  # created with the board connection, see isready
+
+    def index_successors(self, board, current=None):
+        """
+        return an index of board's successors, reusing current if it belongs to
+        board, None if the memo knows board already
+        """
+        if current is not None and current.key == movedetect.position_key(board):
+            return current
+        if current is not None:
+            current.cancel()
+        if self.memo is not None and self.memo.knows(board):
+            # moves not memorised yet are found by codes.get_moves_to()
+            return None
+        return movedetect.SuccessorIndex(board)
+
+    def save_memo(self):
+        if self.memo is None:
+            return
+        try:
+            self.memo.save()
+        except (IOError, OSError) as e:
+            logging.info(f'Cannot save move memo: {str(e)}')
+
+    def report_dropped(self, dropped):
+        """ log when frames were dropped because we could not keep up """
+        if dropped != self.frames_dropped:
+            logging.info(f'dropped {dropped - self.frames_dropped} stale frames, {dropped} in total')
+            self.frames_dropped = dropped
+
+    def report_malformed(self, malformed):
+        """ log when the board sent lines that are no frames, e.g. after a loose contact """
+        if malformed != self.lines_malformed:
+            logging.info(f'skipped {malformed - self.lines_malformed} malformed lines from the board, {malformed} in total')
+            self.lines_malformed = malformed
+
+    def handle_command(self, ucicommand):
+        """ handle one UCI command, returns False on quit """
+        logging.debug('>>> %s ', ucicommand)
+
+        if ucicommand == 'quit':
+            self.save_memo()
+            return False
+
+        elif ucicommand == 'uci':
+            uci_handshake()
+
+        elif ucicommand == 'isready':
+            if not self.board_started:
+                self.board_started = True
+                self.start_board(self.portname)
+                codes.load_calibration(port)
+                self.memo = movedetect.MoveMemo(os.path.join(constants.CERTABO_DATA_PATH, "moves.memo"))
+                # make some nice blinky, frames and commands are handled meanwhile
+                led_animator.play([
+                    (codes.squareset2ledbytes(chess.SquareSet(chess.BB_LIGHT_SQUARES)), 1),
+                    (codes.squareset2ledbytes(chess.SquareSet(chess.BB_DARK_SQUARES)), 1),
+                    (b'\x00' * 8, 0),
+                ])
+
+            if not self.calibration:
+                output('readyok')
+
+        elif ucicommand == 'ucinewgame':
+            logging.debug("new game")
+            self.save_memo()
+
+        elif ucicommand.startswith('setoption name Port value'):
+            _, _, _, _, tmp_portname = ucicommand.split(' ', 4)
+            logging.info(f"Setoption Port received: {tmp_portname}")
+            self.portname = tmp_portname
+
+        elif ucicommand.startswith('setoption name AddPiece value true'):
+            logging.info("Adding new pieces to existing calibration")
+            self.calibration = True
+            self.new_setup = False
+
+        elif ucicommand.startswith('setoption name Calibrate value true'):
+            logging.info("Calibrating board")
+            self.calibration = True
+
+        elif ucicommand == 'setoption name LatencyStats':
+            for line in self.latency.report_lines():
+                output(f'info string {line}')
+            try:
+                self.latency.write(os.path.join(constants.CERTABO_DATA_PATH, "latency-stats.json"))
+            except (IOError, OSError) as e:
+                logging.info(f'Cannot write latency stats: {str(e)}')
+
+        elif ucicommand == 'setoption name Profile value start':
+            if self.profiler is None:
+                import profiler
+                self.profiler = profiler.SamplingProfiler()
+            self.profiler.start()
+            output('info string profiling')
+
+        elif ucicommand == 'setoption name Profile value stop' and self.profiler is not None:
             try:
-                data = serial_in.get()
-                serial_in.task_done()
-                # logging.debug(f'serial data received from serial_in queue: {data}')
-                usb_data = list(map(int, data.split(" ")))
-                new_usb_data = True
-                usb_data_exist = True
-                # logging.debug(f'data from usb {usb_data}')
+                for path in self.profiler.stop(constants.CERTABO_DATA_PATH):
+                    output(f'info string profile written to {path}')
+            except (IOError, OSError) as e:
+                logging.info(f'Cannot write profile: {str(e)}')
+
+        elif ucicommand.startswith('setoption name LogLevel value'):
+            level = ucicommand.split(' ')[-1].upper()
+            if level in LOG_LEVELS:
+                logger.setLevel(level)
+                logging.info(f'Log level set to {level}')
+            else:
+                logging.info(f'invalid LogLevel: {ucicommand}')
 
-            except Exception as e:
-                logging.info(f'No new data from usb, perhaps chess board not connected: {str(e)}')
-
-        if calibration == True and new_usb_data == True:
-            calibration_samples.append(usb_data)
-            new_usb_data = False 
-            logging.info("    adding new calibration sample")
-            calibration_samples_counter += 1
-            if calibration_samples_counter %2:
-                send_leds(b'\xff\xff\x00\x00\x00\x00\xff\xff')
+        elif ucicommand.startswith('setoption name MatchRadius value'):
+            try:
+                radius = int(ucicommand.split(' ')[4])
+            except (IndexError, ValueError):
+                logging.info(f'invalid MatchRadius: {ucicommand}')
             else:
-                send_leds()
-            if calibration_samples_counter >= 15:
+                logging.info(f"Setoption MatchRadius received: {radius}")
+                codes.set_match_radius(max(0, min(8, radius)))
+
+        elif ucicommand.startswith('setoption name Rotate value true'):
+            logging.info("Rotating board")
+            self.rotate180 = True
+
+        elif ucicommand.startswith('position'):
+            if 'startpos' in ucicommand:
+                logging.info(f'position startpos received')
+                self.tmp_chessboard = chess.Board()
+            elif 'fen' in ucicommand:
+                _, _, fen  = ucicommand.split(' ',2)
+                if ' moves ' in fen:
+                    fen = fen.split(' moves ')[0]
+                logging.info(f'position fen received: {fen}')
+                self.tmp_chessboard = chess.Board(fen)
+            else:
+                logging.info(f'ERROR: position received without either startpos keyword or fen. Assuming startpos.')
+                self.tmp_chessboard = chess.Board()
+
+            if ' moves ' in ucicommand:
+                moves = ucicommand.split(' moves ')[1].split(' ')
+                logging.info(f'position contains moves: {moves}')
+                for move in moves:
+                    logging.debug('pushing move: %s', move)
+                    self.tmp_chessboard.push_uci(move)
+
+            logging.info(f'position board state: {self.tmp_chessboard.fen()}')
+            self.next_successors = self.index_successors(self.tmp_chessboard, self.next_successors)
+
+        elif ucicommand.startswith('go'):
+            logging.debug("go...")
+            possible_moves = self.chessboard.legal_moves
+            logging.debug('legal moves: %s', possible_moves)
+            if self.tmp_chessboard.fen() == chess.STARTING_FEN:
+                # we did receive a starting FEN, so it is our turn and we're white
+                logging.info(f'we received a starting FEN, we are white and it is our turn')
+                self.mystate = "user_shall_place_his_move"
+                self.successors = self.index_successors(self.chessboard, self.successors)
+            else:
+                try:
+                    new_move = movedetect.find_moves(self.successors, self.chessboard, codes.placement_key(self.tmp_chessboard), self.memo)
+                    logging.info(f'bot opponent played: {new_move}')
+                    self.chessboard = self.tmp_chessboard
+                    self.mystate = "user_shall_place_oppt_move"
+                except codes.InvalidMove:
+                    logging.debug('cannot find move, assume new game from FEN')
+                    self.chessboard = self.tmp_chessboard
+                    self.mystate = "user_shall_place_his_move"
+                self.successors = self.index_successors(self.chessboard, self.next_successors)
+
+        else:
+            logging.debug('unhandled: %s', ucicommand)
+        return True
+
+    def handle_frame(self, usb_data, received=None, parsed=None):
+        """
+        handle one frame of sensor data from the board, received and parsed are
+        the time.monotonic() its data was read and parsed at
+        """
+        started = time.monotonic()
+        if received is None:
+            received = parsed = started
+        self.latency.record('read', parsed - received)
+        self.latency.record('queue', started - parsed)
+        self.frame_received = received
+        self.process_frame(usb_data)
+        self.latency.record('frame', time.monotonic() - received)
+
+    def process_frame(self, usb_data):
+        if self.calibration:
+            done = self.calibration_samples.add(usb_data)
+            n_samples = len(self.calibration_samples.samples)
+            logging.debug("    adding new calibration sample")
+            if self.calibration_animation is None:
+                self.calibration_animation = led_animator.play(calibration_blink, repeat=True)
+            if done:
                 logging.info(
-                    "------- we have collected enough samples for averaging ----"
+                    f"------- calibration codes are stable after {n_samples} samples ----"
                 )
-                usb_data = codes.statistic_processing_for_calibration(
-                    calibration_samples, False
+                usb_data = calibration_vote().statistic_processing_for_calibration(
+                    self.calibration_samples.samples, False
                 )
-                codes.calibration(usb_data, new_setup, port)
-                calibration = False
+                self.calibration_samples.reset()
+                codes.calibration(usb_data, self.new_setup, port)
+                self.calibration = False
                 output('readyok') # as calibration takes some time, we safely(?) assume that "isready" has already been sent, so we reply readyness
+                led_animator.cancel(self.calibration_animation)
+                self.calibration_animation = None
                 send_leds()
+            return
+
+        started = time.monotonic()
+        usb_data_processed = self.usb_data_filter.push(usb_data)
+        self.latency.record('filter', time.monotonic() - started)
+        if usb_data_processed is None:
+            return
+        # nothing to do while neither the sensors nor the state they are compared with change
+        started = time.monotonic()
+        board_placement = codes.placement_key(self.chessboard)
+        board_key = (board_placement, self.mystate, self.rotate180)
+        if not self.usb_data_decoder.update(usb_data_processed) and board_key == self.last_board_key:
+            return
+        self.last_board_key = board_key
+        usb_placement = self.usb_data_decoder.placement(self.rotate180)
+        self.latency.record('decode', time.monotonic() - started)
+        if usb_placement is None:
+            return
+        # compare virtual board state and state from usb
+        diffmap = codes.placement_diff(board_placement, usb_placement)
+        if diffmap and (self.mystate != 'init'):
+            if self.mystate == "user_shall_place_oppt_move":
+                logging.debug('Difference on Squares:\n%s', chess.SquareSet(diffmap))
+                send_leds(codes.squareset2ledbytes(diffmap,self.rotate180))
+                logging.info("move for opponent")
+                output(f'info string move for opponent')
+            elif self.mystate == "user_shall_place_his_move":
+                try:
+                    self.move_detect_tries += 1
+                    started = time.monotonic()
+                    try:
+                        move = movedetect.find_moves(self.successors, self.chessboard, usb_placement, self.memo)
+                    finally:
+                        self.latency.record('detect', time.monotonic() - started)
+                    logging.debug('moves difference: %s, move count: %d', move, len(move))
+                    if len(move) == 1:
+                        # single move
+                        bestmove = move[0]
+                        if chess.Move.from_uci(bestmove) in list(self.chessboard.legal_moves):
+                            logging.debug('valid move')
+                            logging.info("user moves")
+                            self.chessboard.push_uci(bestmove)
+                            started = time.monotonic()
+                            output(f'bestmove {bestmove}')
+                            finished = time.monotonic()
+                            self.latency.record('output', finished - started)
+                            self.latency.record('bestmove', finished - self.frame_received)
+                            # ready to recognise the opponent's reply at the next go
+                            self.successors = self.index_successors(self.chessboard)
+                            self.mystate = "init"
+                        else:
+                            logging.info('invalid move')
+                except codes.InvalidMove:
+                    logging.debug('Difference on Squares:\n%s', chess.SquareSet(diffmap))
+                    send_leds(codes.squareset2ledbytes(diffmap,self.rotate180))
+
+                    if self.move_detect_tries > self.move_detect_max_tries:
+                        logging.info("Invalid move")
+                    else:
+                        self.move_detect_tries = 0
+
+            else:
+                logging.debug('Difference on Squares:\n%s', chess.SquareSet(diffmap))
+                send_leds(codes.squareset2ledbytes(diffmap,self.rotate180))
+                output(f'info string place pieces on their places: {self.chessboard.fen()}')
+        else: # board is the same
+            if self.mystate == "user_shall_place_oppt_move":
+                logging.info("user has moved opponent, now it's his own turn")
+                self.mystate = "user_shall_place_his_move"
+            send_leds()
 
-        if not stack.empty():
-            logging.debug(f'getting uci command from stack')
+def main():
+    inputthread = ucireader('sys.stdin')
+    inputthread.daemon = True
+    inputthread.start()
+    timerthread = ledtimer()
+    timerthread.daemon = True
+    timerthread.start()
+
+    def start_board(device):
+        serialthread = serialreader(device)
+        serialthread.daemon = True
+        serialthread.start()
+
+    # GUIs give an engine little time for the handshake, so it is answered
+    # before the engine's modules are imported
+    ucicommand = stack.get()
+    stack.task_done()
+    if ucicommand == 'uci':
+        uci_handshake()
+        ucicommand = None
+    import_engine_modules()
+    engine = certaboengine(start_board)
+    if ucicommand is not None and not engine.handle_command(ucicommand):
+        return
+
+    while True:
+        # cleared before looking, so what arrives meanwhile is not missed
+        inbox.wait()
+        inbox.clear()
+
+        frame = serial_in.get()
+        while frame is not None:
+            engine.handle_frame(*frame)
+            frame = serial_in.get()
+        engine.report_dropped(serial_in.dropped)
+        engine.report_malformed(serial_transport.reader.malformed)
+
+        while not stack.empty():
+            logging.debug('getting uci command from stack')
             ucicommand = stack.get()
             stack.task_done()
-            logging.debug(f'>>> {ucicommand} ')
+            running = engine.handle_command(ucicommand)
+            start_log_file()
+            if not running:
+                return
+
+async def async_main():
+    """
+    Single threaded variant of main(): UCI commands, sensor frames and LED
+    output are all handled by coroutines and fd callbacks on one event loop.
+    """
+    loop = asyncio.get_running_loop()
+    board_task = None
+
+    def start_board(device):
+        nonlocal board_task
+        board_task = asyncio.ensure_future(board_link(device))
+
+    led_timer = None
+
+    def run_leds():
+        # one timer handle at most, for the next LED message that is due
+        nonlocal led_timer
+        if led_timer is not None:
+            led_timer.cancel()
+        due = led_animator.run_due()
+        led_timer = None if due is None else loop.call_later(max(due - time.monotonic(), 0), run_leds)
+
+    led_animator.wakeup = lambda: loop.call_soon(run_leds)
+
+    async def board_link(device):
+        while True:
+            try:
+                # opening and auto detection block, keep them off the loop
+                uart = await loop.run_in_executor(None, open_board, device)
+            except Exception as e:
+                logging.info(f'ERROR: Cannot open serial port {device}: {str(e)}')
+                await asyncio.sleep(0.1)
+                continue
+            if uart is None:
+                await asyncio.sleep(1)
+                continue
+            serial_transport.attach(uart)
+            led_output.invalidate()
+            failed = loop.create_future()
+
+            def on_error(e):
+                if not failed.done():
+                    failed.set_result(e)
+
+            def readable():
+                try:
+                    serial_transport.receive()
+                except Exception as e:
+                    on_error(e)
+                # a burst of data only gets its newest frames handled
+                frame = serial_in.get()
+                while frame is not None:
+                    engine.handle_frame(*frame)
+                    frame = serial_in.get()
+                engine.report_dropped(serial_in.dropped)
+                engine.report_malformed(serial_transport.reader.malformed)
+
+            def wake():
+                serial_transport.drain_wake()
+                flush()
+
+            def flush():
+                try:
+                    if serial_transport.flush():
+                        loop.remove_writer(serial_transport.fd)
+                    else:
+                        loop.add_writer(serial_transport.fd, flush)
+                except Exception as e:
+                    on_error(e)
 
-            if ucicommand == 'quit':
+            fd = serial_transport.fd
+            loop.add_reader(fd, readable)
+            loop.add_reader(serial_transport.wake_r, wake)
+            flush()
+            try:
+                e = await failed
+                logging.info(f'Exception during serial communication: {str(e)}')
+            finally:
+                loop.remove_reader(fd)
+                loop.remove_writer(fd)
+                loop.remove_reader(serial_transport.wake_r)
+                serial_transport.detach()
+
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    engine = None
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                # we quit
                 break
-
-            elif ucicommand == 'uci':
-                output('id name CERTABO physical board')
-                output('id author Harald Klein (based on work from Thomas Ahle & Contributors)')
-                output('option name Calibrate type check default false')
-                output('option name AddPiece type check default false')
-                output('option name Rotate type check default false')
-                output('option name Port type string default auto')
-                output('uciok')
-
-            elif ucicommand == 'isready':
-                if not serial_thread_spawned:
-                    serial_thread_spawned = True
-                    serialthread = serialreader(portname)
-                    serialthread.daemon = True
-                    serialthread.start()
-                    codes.load_calibration(port)
-                    # make some nice blinky
-                    send_leds(codes.squareset2ledbytes(chess.SquareSet(chess.BB_LIGHT_SQUARES)))
-                    time.sleep(1)
-                    send_leds(codes.squareset2ledbytes(chess.SquareSet(chess.BB_DARK_SQUARES)))
-                    time.sleep(1)
-                    send_leds()
-
-                if not calibration:
-                    output('readyok')
-
-            elif ucicommand == 'ucinewgame':
-                logging.debug("new game")
-
-            elif ucicommand.startswith('setoption name Port value'):
-                _, _, _, _, tmp_portname = ucicommand.split(' ', 4)
-                logging.info(f"Setoption Port received: {tmp_portname}")
-                portname = tmp_portname
-
-            elif ucicommand.startswith('setoption name AddPiece value true'):
-                logging.info("Adding new pieces to existing calibration")
-                calibration = True
-                new_setup = False
-
-            elif ucicommand.startswith('setoption name Calibrate value true'):
-                logging.info("Calibrating board")
-                calibration = True
-
-            elif ucicommand.startswith('setoption name Rotate value true'):
-                logging.info("Rotating board")
-                rotate180 = True
-
-            elif ucicommand.startswith('position'):
-                if 'startpos' in ucicommand:
-                    logging.info(f'position startpos received')
-                    tmp_chessboard = chess.Board()
-                elif 'fen' in ucicommand:
-                    _, _, fen  = ucicommand.split(' ',2)
-                    if ' moves ' in fen:
-                        fen = fen.split(' moves ')[0]
-                    logging.info(f'position fen received: {fen}')
-                    tmp_chessboard = chess.Board(fen)
-                else:
-                    logging.info(f'ERROR: position received without either startpos keyword or fen. Assuming startpos.')
-                    tmp_chessboard = chess.Board()
-
-                if ' moves ' in ucicommand:
-                    moves = ucicommand.split(' moves ')[1].split(' ')
-                    logging.info(f'position contains moves: {moves}')
-                    for move in moves:
-                        logging.debug(f'pushing move: {move}')
-                        tmp_chessboard.push_uci(move)
-
-                logging.info(f'position board state: {tmp_chessboard.fen()}')
-
-            elif ucicommand.startswith('go'):
-                logging.debug("go...")
-                possible_moves = list(chessboard.legal_moves)
-                logging.debug(f'legal moves: {possible_moves}')
-                if tmp_chessboard.fen() == chess.STARTING_FEN:
-                    # we did receive a starting FEN, so it is our turn and we're white
-                    logging.info(f'we received a starting FEN, we are white and it is our turn')
-                    mystate = "user_shall_place_his_move"
-                else:
-                    try:
-                        new_move = codes.get_moves(chessboard, tmp_chessboard.fen)
-                        logging.info(f'bot opponent played: {new_move}')
-                        chessboard = tmp_chessboard
-                        mystate = "user_shall_place_oppt_move"
-                    except:
-                        logging.debug(f'cannot find move, assume new game from FEN')
-                        chessboard = tmp_chessboard
-                        mystate = "user_shall_place_his_move"
-
-            else:
-                logging.debug(f'unhandled: {ucicommand}')
-                pass
-        
-        if new_usb_data:
-            new_usb_data = False
-
-            if usb_data_history_i >= usb_data_history_depth:
-                usb_data_history_filled = True
-                usb_data_history_i = 0
-
-            usb_data_history[usb_data_history_i] = list(usb_data)[:]
-            usb_data_history_i += 1
-            if usb_data_history_filled:
-                usb_data_processed = codes.statistic_processing(usb_data_history, False)
-                if usb_data_processed != []:
-                    test_state = codes.usb_data_to_FEN(usb_data_processed, rotate180)
-                    if test_state != "":
-                        board_state_usb = test_state
-                        # output(f'info string FEN {board_state_usb}')
-                        # compare virtual board state and state from usb
-                        s1 = chessboard.board_fen()
-                        s2 = board_state_usb.split(" ")[0]
-                        if (s1 != s2) and (mystate != 'init'):
-                            if mystate == "user_shall_place_oppt_move":
-                                diffmap = codes.diff2squareset(s1, s2)
-                                logging.debug(f'Difference on Squares:\n{diffmap}')
-                                send_leds(codes.squareset2ledbytes(diffmap,rotate180))
-                                logging.info("move for opponent")
-                                output(f'info string move for opponent')
-                            elif mystate == "user_shall_place_his_move":
-                                try:
-                                    move_detect_tries += 1
-                                    move = codes.get_moves(chessboard, board_state_usb)
-                                    logging.debug(f'moves difference: {move}')
-                                    logging.debug(f'move count: {len(move)}')
-                                    if len(move) == 1:
-                                        # single move
-                                        bestmove = move[0]
-                                        legal_moves = list(chessboard.legal_moves)
-                                        if chess.Move.from_uci(bestmove) in list(chessboard.legal_moves):
-                                            logging.debug('valid move')
-                                            logging.info("user moves")
-                                            chessboard.push_uci(bestmove)
-                                            output(f'bestmove {bestmove}')
-                                            mystate = "init"
-                                        else:
-                                            logging.info('invalid move')
-                                except codes.InvalidMove:
-                                    diffmap = codes.diff2squareset(s1, s2)
-                                    logging.debug(f'Difference on Squares:\n{diffmap}')
-                                    send_leds(codes.squareset2ledbytes(diffmap,rotate180))
-
-                                    if move_detect_tries > move_detect_max_tries:
-                                        logging.info("Invalid move")
-                                    else:
-                                        move_detect_tries = 0
-
-                            else:
-                                diffmap = codes.diff2squareset(s1, s2)
-                                logging.debug(f'Difference on Squares:\n{diffmap}')
-                                send_leds(codes.squareset2ledbytes(diffmap,rotate180))
-                                output(f'info string place pieces on their places: {chessboard.fen()}')
-                        else: # board is the same
-                            if mystate == "user_shall_place_oppt_move":
-                                logging.info("user has moved opponent, now it's his own turn")
-                                mystate = "user_shall_place_his_move" 
-                            send_leds()
+            ucicommand = line.decode().rstrip('\r\n')
+            if engine is None:
+                # like in main(), the handshake comes before the engine's modules
+                if ucicommand == 'uci':
+                    uci_handshake()
+                    start_log_file()
+                    ucicommand = None
+                import_engine_modules()
+                engine = certaboengine(start_board)
+                if ucicommand is None:
+                    continue
+            running = engine.handle_command(ucicommand)
+            start_log_file()
+            if not running:
+                break
+    finally:
+        if board_task is not None:
+            board_task.cancel()
 
 if __name__ == '__main__':
-    main()
-
+    if args.asyncio:
+        import asyncio
+        asyncio.run(async_main())
+    else:
+        main()
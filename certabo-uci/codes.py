@@ -2,13 +2,19 @@ from __future__ import print_function
 import pickle
 import os
 import chess
-from constants import CERTABO_DATA_PATH
+import constants
 import logging
 import struct
 
 # data conversion
 p, r, n, b, k, q, P, R, N, B, K, Q = [], [], [], [], [], [], [], [], [], [], [], []
 
+# cell code -> piece name, rebuilt from the lists above by build_piece_index()
+piece_index = {}
+
+# order in which the lists used to be scanned, a later match wins on ambiguous codes
+piece_lookup_order = "p", "P", "r", "R", "n", "N", "b", "B", "q", "Q", "k", "K"
+
 # for calibration
 def cell_codes(n_cell, usb_data):  # n_cell from 0 to 63, 0 at left top
     result = []
@@ -17,6 +23,10 @@ def cell_codes(n_cell, usb_data):  # n_cell from 0 to 63, 0 at left top
     return result
 
 
+def cell_key(n_cell, usb_data):
+    return tuple(usb_data[n_cell * 5:n_cell * 5 + 5])
+
+
 def compare_cells(x, y):
     # l = len( frozenset(x).intersection(y) )
     if x[0] == y[0] and x[1] == y[1] and x[2] == y[2] and x[3] == y[3] and x[4] == y[4]:
@@ -25,25 +35,247 @@ def compare_cells(x, y):
         return False
 
 
-def get_calibration_file_name(port):
+def get_calibration_file_name(port, extension="cal"):
     if port is None:
-        return "calibration.bin"
+        return "calibration.{}".format(extension)
     else:
-        return "calibration-com{}.bin".format(port + 1)
+        return "calibration-com{}.{}".format(port + 1, extension)
+
+
+# calibration file: header, then (code, piece) entries sorted by code, the
+# code being the 5 cell bytes as a big endian 40-bit integer and the piece
+# its position in calibration_pieces
+calibration_magic = b"CCAL"
+calibration_version = 1
+calibration_header = struct.Struct("<4sHH")  # magic, version, number of entries
+calibration_entry = struct.Struct("<5sB")
+calibration_pieces = "prnbkqPRNBKQ"
+
+
+def pack_calibration(lists):
+    entries = sorted(
+        (bytes(cell), piece)
+        for piece, cells in enumerate(lists)
+        for cell in cells
+    )
+    chunks = [calibration_header.pack(calibration_magic, calibration_version, len(entries))]
+    chunks += [calibration_entry.pack(code, piece) for code, piece in entries]
+    return b"".join(chunks)
+
+
+def unpack_calibration(data):
+    """ the 12 calibration lists from a calibration file, raises ValueError if it is broken """
+    try:
+        magic, version, count = calibration_header.unpack_from(data)
+    except struct.error:
+        raise ValueError("calibration file too short")
+    if magic != calibration_magic:
+        raise ValueError("not a calibration file")
+    if version != calibration_version:
+        raise ValueError("unsupported calibration file version {}".format(version))
+    if len(data) != calibration_header.size + count * calibration_entry.size:
+        raise ValueError("calibration file has the wrong size")
+    lists = tuple([] for _ in calibration_pieces)
+    for code, piece in calibration_entry.iter_unpack(data[calibration_header.size:]):
+        if piece >= len(lists):
+            raise ValueError("bad piece number {} in calibration file".format(piece))
+        lists[piece].append(list(code))
+    return lists
+
+
+def save_calibration(port, lists):
+    path = os.path.join(constants.CERTABO_DATA_PATH, get_calibration_file_name(port))
+    with open(path + ".tmp", "wb") as f:
+        f.write(pack_calibration(lists))
+    os.replace(path + ".tmp", path)
+
+
+class CalibrationUnpickler(pickle.Unpickler):
+    """ unpickles the old calibration files, which only hold tuples, lists and ints """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("calibration file refers to {}.{}".format(module, name))
+
+
+def load_pickled_calibration(port):
+    """ the calibration lists from an old pickle file, raises ValueError if its content is not a calibration """
+    with open(os.path.join(constants.CERTABO_DATA_PATH, get_calibration_file_name(port, "bin")), "rb") as f:
+        try:
+            lists = CalibrationUnpickler(f).load()
+        except (pickle.UnpicklingError, EOFError) as e:
+            raise ValueError(str(e))
+    if not isinstance(lists, (tuple, list)) or len(lists) != len(calibration_pieces):
+        raise ValueError("unexpected calibration data")
+    for cells in lists:
+        for cell in cells:
+            if len(cell) != 5 or not all(isinstance(value, int) and 0 <= value < 256 for value in cell):
+                raise ValueError("unexpected calibration code {}".format(cell))
+    return tuple([list(cell) for cell in cells] for cells in lists)
+
+
+def code_int(cell):
+    """ the 5 bytes of a cell code as one 40-bit integer """
+    return int.from_bytes(bytes(cell), "big")
+
+
+def code_distance(x, y):
+    """ number of differing bits between two code_int()s """
+    return bin(x ^ y).count("1")
+
+
+class CodeTree:
+    """
+    BK-tree over the calibrated codes, finds the codes within a number of
+    differing bits of a code without comparing it to all of them.
+    Nodes are [code_int, cell code, piece name, {distance: child}].
+    """
+
+    def __init__(self, index):
+        self.root = None
+        for cell, name in index.items():
+            self.add(cell, name)
+
+    def add(self, cell, name):
+        node = [code_int(cell), cell, name, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = code_distance(current[0], node[0])
+            child = current[3].get(distance)
+            if child is None:
+                current[3][distance] = node
+                return
+            current = child
+
+    def search(self, cell, radius):
+        """ (distance, cell code, piece name) of all codes within radius bits of cell """
+        code = code_int(cell)
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = code_distance(node[0], code)
+            if distance <= radius:
+                found.append((distance, node[1], node[2]))
+            for child_distance, child in node[3].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+        return found
+
+
+# unknown codes within match_radius bits of a calibrated code are read as
+# that piece if no other piece is nearly as close, see match_code()
+match_radius = constants.MATCH_RADIUS_DEFAULT
+match_confidence = 0.5
+code_tree = CodeTree({})
+near_matches = {}  # cell code -> match_code() result, cleared with the index
+
+
+def match_code(cell):
+    """
+    Nearest calibrated code of an unknown cell code as (cell code, piece name,
+    confidence), None if there is none within match_radius or another piece
+    is too close as well. The confidence is 1 - distance / distance to the
+    nearest code of another piece, 1 for an exact match.
+    """
+    if cell in near_matches:
+        return near_matches[cell]
+    match = None
+    if match_radius:
+        hits = sorted(code_tree.search(cell, 2 * match_radius + 1))
+        if hits and hits[0][0] <= match_radius:
+            distance, code, name = hits[0]
+            other = min((hit[0] for hit in hits if hit[2] != name), default=2 * match_radius + 2)
+            confidence = 1 - distance / other
+            if confidence >= match_confidence:
+                match = (code, name, confidence)
+                logging.debug("Reading code %s as %s, %d bits off, confidence %.2f", cell, name, distance, confidence)
+    if len(near_matches) >= 4096:
+        near_matches.clear()
+    near_matches[cell] = match
+    return match
+
+
+empty_code = (0, 0, 0, 0, 0)
+
+
+def canonical_code(cell):
+    """
+    the calibrated code a reading stands for (see match_code()), empty_code
+    for every empty reading, None if unknown
+    """
+    if cell_empty(cell):
+        return empty_code
+    if cell in piece_index:
+        return cell
+    match = match_code(cell)
+    return match[0] if match else None
+
+
+def set_match_radius(radius):
+    """ change match_radius, the piece index is rebuilt so cached readings are redone """
+    global match_radius
+    match_radius = radius
+    build_piece_index()
+
+
+def build_piece_index():
+    """
+    Rebuild piece_index from the calibration lists and return the list of
+    conflicting (code, names) pairs found on the way.
+    """
+    global piece_index, code_tree
+    lists = dict(zip("prnbkqPRNBKQ", (p, r, n, b, k, q, P, R, N, B, K, Q)))
+    index = {}
+    seen = {}
+    for name in piece_lookup_order:
+        for cell in lists[name]:
+            key = tuple(cell)
+            index[key] = name
+            seen.setdefault(key, [])
+            if name not in seen[key]:
+                seen[key].append(name)
+    conflicts = []
+    for key, names in seen.items():
+        if len(names) > 1:
+            logging.warning("Calibration code %s is shared by %s, using %s", key, ", ".join(names), names[-1])
+            conflicts.append((key, names))
+        if cell_empty(key):
+            logging.warning("Calibration code %s for %s looks like an empty cell", key, names[-1])
+            conflicts.append((key, ["-"] + names))
+    piece_index = index
+    code_tree = CodeTree(index)
+    near_matches.clear()
+    return conflicts
 
 
 def load_calibration(port):
     global p, r, n, b, k, q, P, R, N, B, K, Q
     logging.info("codes.py - loading calibration")
     try:
-        p, r, n, b, k, q, P, R, N, B, K, Q = pickle.load(
-            open(os.path.join(CERTABO_DATA_PATH, get_calibration_file_name(port)), "rb")
-        )
+        with open(os.path.join(constants.CERTABO_DATA_PATH, get_calibration_file_name(port)), "rb") as f:
+            lists = unpack_calibration(f.read())
     except (IOError, OSError):
+        # no calibration in the current format yet, migrate an old pickled one
+        try:
+            lists = load_pickled_calibration(port)
+        except (IOError, OSError):
+            return False
+        except ValueError as e:
+            logging.info("Can't load calibration data: %s", e)
+            return False
+        logging.info("Converting %s", get_calibration_file_name(port, "bin"))
+        try:
+            save_calibration(port, lists)
+        except (IOError, OSError) as e:
+            logging.info("Can't save converted calibration: %s", e)
+    except ValueError as e:
+        logging.info("Can't load calibration data: %s", e)
         return False
-    except ValueError:
-        logging.info("Can't load calibration data")
-        return False
+    p, r, n, b, k, q, P, R, N, B, K, Q = lists
+    build_piece_index()
     return True
 
 
@@ -80,46 +312,9 @@ def statistic_processing_for_calibration(samples, show_print):
 
 
 def get_name(cell):
-    global p, r, n, b, k, q, P, R, N, B, K, Q
-    c = ""
-    if cell_empty(cell):
-        c = "-"
-    for cell_p in p:
-        if compare_cells(cell, cell_p):
-            c = "p"
-    for cell_p in P:
-        if compare_cells(cell, cell_p):
-            c = "P"
-    for cell_p in r:
-        if compare_cells(cell, cell_p):
-            c = "r"
-    for cell_p in R:
-        if compare_cells(cell, cell_p):
-            c = "R"
-    for cell_p in n:
-        if compare_cells(cell, cell_p):
-            c = "n"
-    for cell_p in N:
-        if compare_cells(cell, cell_p):
-            c = "N"
-    for cell_p in b:
-        if compare_cells(cell, cell_p):
-            c = "b"
-    for cell_p in B:
-        if compare_cells(cell, cell_p):
-            c = "B"
-    for cell_p in q:
-        if compare_cells(cell, cell_p):
-            c = "q"
-    for cell_p in Q:
-        if compare_cells(cell, cell_p):
-            c = "Q"
-    for cell_p in k:
-        if compare_cells(cell, cell_p):
-            c = "k"
-    for cell_p in K:
-        if compare_cells(cell, cell_p):
-            c = "K"
+    c = piece_index.get(tuple(cell))
+    if c is None:
+        c = "-" if cell_empty(cell) else ""
     return c
 
 
@@ -252,17 +447,12 @@ def calibration(usb_data, new_setup, port):
     )
 
     def add_new(pnew, pcurrent, pprevious):
+        current = set(map(tuple, pcurrent))
         for previous in pprevious:
-            previous_not_in_current = True
-            for current in pcurrent:
-                if compare_cells(current, previous):
-                    previous_not_in_current = False
-                    break
-            if previous_not_in_current:
-                logging.info("previous not in current")
+            if tuple(previous) not in current:
+                current.add(tuple(previous))
                 pnew.append(previous)
-            else:
-                logging.info("previous in current")
+        logging.info("kept %d of %d previous codes", len(pnew) - len(pcurrent), len(pprevious))
         return pnew
 
     logging.info("Q before = %s", Qn)
@@ -299,7 +489,8 @@ def calibration(usb_data, new_setup, port):
             Kn,
             Qn,
         )
-    pickle.dump(results, open(os.path.join(CERTABO_DATA_PATH, get_calibration_file_name(port)), "wb"))
+    save_calibration(port, results)
+    build_piece_index()
 
     logging.info("----------------")
     # print r
@@ -313,43 +504,8 @@ def calibration(usb_data, new_setup, port):
             # print empty_cell
             if cell_empty(cell):
                 row.append("-")
-            else:  # not empty
-                for cell_p in p:
-                    if compare_cells(cell, cell_p):
-                        row.append("p")
-                for cell_p in P:
-                    if compare_cells(cell, cell_p):
-                        row.append("P")
-                for cell_p in r:
-                    if compare_cells(cell, cell_p):
-                        row.append("r")
-                for cell_p in R:
-                    if compare_cells(cell, cell_p):
-                        row.append("R")
-                for cell_p in n:
-                    if compare_cells(cell, cell_p):
-                        row.append("n")
-                for cell_p in N:
-                    if compare_cells(cell, cell_p):
-                        row.append("N")
-                for cell_p in b:
-                    if compare_cells(cell, cell_p):
-                        row.append("b")
-                for cell_p in B:
-                    if compare_cells(cell, cell_p):
-                        row.append("B")
-                for cell_p in q:
-                    if compare_cells(cell, cell_p):
-                        row.append("q")
-                for cell_p in Q:
-                    if compare_cells(cell, cell_p):
-                        row.append("Q")
-                for cell_p in k:
-                    if compare_cells(cell, cell_p):
-                        row.append("k")
-                for cell_p in K:
-                    if compare_cells(cell, cell_p):
-                        row.append("K")
+            elif tuple(cell) in piece_index:
+                row.append(piece_index[tuple(cell)])
         logging.info(" ".join(row))
 
 
@@ -357,8 +513,12 @@ letter = "a", "b", "c", "d", "e", "f", "g", "h"
 reversed_letter = tuple(reversed(letter))
 
 
+# every byte value with its bit order reversed
+reversed_byte_bits = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
 def reverse_bits(n):
-    return int('{:064b}'.format(n)[::-1], 2)
+    return int.from_bytes(n.to_bytes(8, 'little').translate(reversed_byte_bits), 'big')
 
 
 def move2led(move, rotate180=False):
@@ -388,22 +548,10 @@ def move2ledbytes(move, rotate180=False):
             message.append(value_source)
     return message
 
-def diff2squareset(s1, s2):
-    board1 = chess.BaseBoard(s1)
-    board2 = chess.BaseBoard(s2)
-    diffmap = chess.SquareSet()
-    for x in range(chess.A1, chess.H8+1):
-        if board1.piece_at(x) != board2.piece_at(x):
-            diffmap.add(x)
-    return diffmap
-
 def squareset2ledbytes(squareset, rotate180=False):
     # we pack the uint64 squareset bitmask into a big endian bytearray
     if (rotate180): # as squareset has only a mirror() method but no rotate, we're packing little endian and reverse bits of each byte
-        result = bytes()
-        for n in struct.pack('<Q',squareset):
-            result += int('{:08b}'.format(n)[::-1], 2).to_bytes(1,'little')
-        return result
+        return struct.pack('<Q',squareset).translate(reversed_byte_bits)
     return struct.pack('>Q',squareset)
 
 def usb_data_to_FEN(usb_data, rotate180=False):
@@ -416,50 +564,14 @@ def usb_data_to_FEN(usb_data, rotate180=False):
         c = ""
         empty_cells_counter = 0
         for i in range(8):
-            cell = cell_codes(i + j * 8, usb_data)
+            cell = cell_key(i + j * 8, usb_data)
             c = "unknown"
 
             if cell_empty(cell):
                 c = "-"
                 empty_cells_counter += 1
             else:  # not empty
-
-                for cell_p in p:
-                    if compare_cells(cell, cell_p):
-                        c = "p"
-                for cell_p in P:
-                    if compare_cells(cell, cell_p):
-                        c = "P"
-                for cell_p in r:
-                    if compare_cells(cell, cell_p):
-                        c = "r"
-                for cell_p in R:
-                    if compare_cells(cell, cell_p):
-                        c = "R"
-                for cell_p in n:
-                    if compare_cells(cell, cell_p):
-                        c = "n"
-                for cell_p in N:
-                    if compare_cells(cell, cell_p):
-                        c = "N"
-                for cell_p in b:
-                    if compare_cells(cell, cell_p):
-                        c = "b"
-                for cell_p in B:
-                    if compare_cells(cell, cell_p):
-                        c = "B"
-                for cell_p in q:
-                    if compare_cells(cell, cell_p):
-                        c = "q"
-                for cell_p in Q:
-                    if compare_cells(cell, cell_p):
-                        c = "Q"
-                for cell_p in k:
-                    if compare_cells(cell, cell_p):
-                        c = "k"
-                for cell_p in K:
-                    if compare_cells(cell, cell_p):
-                        c = "K"
+                c = piece_index.get(cell, "unknown")
 
                 if empty_cells_counter > 0 and c != "-":
                     s += str(empty_cells_counter)
@@ -492,6 +604,95 @@ def usb_data_to_FEN(usb_data, rotate180=False):
     return s
 
 
+def cell_name(cell):
+    # same rules as usb_data_to_FEN() plus match_code(), "" for an unknown code
+    if cell_empty(cell):
+        return "-"
+    name = piece_index.get(cell)
+    if name is None:
+        match = match_code(cell)
+        return match[1] if match else ""
+    return name
+
+
+def placement_key(board):
+    """ hashable piece placement of a chess.BaseBoard, cheaper than board_fen() """
+    return (
+        board.occupied_co[chess.WHITE],
+        board.occupied_co[chess.BLACK],
+        board.pawns,
+        board.knights,
+        board.bishops,
+        board.rooks,
+        board.queens,
+        board.kings,
+    )
+
+
+# cell number (0 at the top left) -> square, as seen from white and rotated
+CELL_SQUARE = tuple(chess.square(n_cell % 8, 7 - n_cell // 8) for n_cell in range(64))
+CELL_SQUARE_ROTATED = tuple(chess.H8 - square for square in CELL_SQUARE)
+
+# piece name -> (colour mask, piece type mask) positions in a placement_key()
+piece_slots = {
+    name: (0 if name.isupper() else 1, 1 + chess.PIECE_SYMBOLS.index(name.lower()))
+    for name in "pnbrqkPNBRQK"
+}
+
+
+def names_to_placement(names, rotate180=False):
+    """
+    Build the placement_key() for 64 cell names as returned by cell_name()
+    without going through a FEN. Returns None if a cell is unknown.
+    """
+    squares = CELL_SQUARE_ROTATED if rotate180 else CELL_SQUARE
+    masks = [0] * 8
+    for n_cell, name in enumerate(names):
+        if name == "-":
+            continue
+        slots = piece_slots.get(name)
+        if slots is None:
+            logging.info("Unknown piece at %s", letter[n_cell % 8] + str(8 - n_cell // 8))
+            return None
+        bit = chess.BB_SQUARES[squares[n_cell]]
+        masks[slots[0]] |= bit
+        masks[slots[1]] |= bit
+    return tuple(masks)
+
+
+class DeltaDecoder:
+    """
+    Decodes frames cell by cell, remembering the code and name of every cell
+    so only the cells whose code changed since the last frame are looked up.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.usb_data = None
+        self.cells = [None] * 64
+        self.names = [""] * 64
+        self.index = piece_index
+
+    def update(self, usb_data):
+        """ decode a frame, returns False if it is identical to the previous one """
+        if self.index is not piece_index:
+            self.reset()
+        if usb_data == self.usb_data:
+            return False
+        self.usb_data = usb_data[:]
+        for n_cell in range(64):
+            cell = cell_key(n_cell, usb_data)
+            if cell != self.cells[n_cell]:
+                self.cells[n_cell] = cell
+                self.names[n_cell] = cell_name(cell)
+        return True
+
+    def placement(self, rotate180=False):
+        return names_to_placement(self.names, rotate180)
+
+
 black_pieces = "r", "b", "k", "n", "p", "q"
 white_pieces = "R", "B", "K", "N", "P", "Q"
 
@@ -597,6 +798,28 @@ class InvalidMove(Exception):
     pass
 
 
+def placement_diff(key1, key2):
+    """ mask of the squares whose piece differs between two placement_key()s """
+    diff = 0
+    for mask1, mask2 in zip(key1, key2):
+        diff |= mask1 ^ mask2
+    return diff
+
+
+def move_squares(board, move):
+    """ mask of the squares whose content changes when move is played on board """
+    squares = chess.BB_SQUARES[move.from_square] | chess.BB_SQUARES[move.to_square]
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        if chess.square_file(move.to_square) > chess.square_file(move.from_square):
+            squares |= chess.BB_SQUARES[chess.square(7, rank)] | chess.BB_SQUARES[chess.square(5, rank)]
+        else:
+            squares |= chess.BB_SQUARES[chess.square(0, rank)] | chess.BB_SQUARES[chess.square(3, rank)]
+    elif board.is_en_passant(move):
+        squares |= chess.BB_SQUARES[chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square))]
+    return squares
+
+
 def get_moves(board, fen):
     """
     :param board:
@@ -605,26 +828,39 @@ def get_moves(board, fen):
     :param max_depth:
     :return:
     """
-    board_fen = fen.split()[0]
-    logging.debug('Getting diff between {} and {}'.format(board.board_fen(), board_fen))
-    if board.board_fen() == board_fen:
+    return get_moves_to(board, placement_key(chess.BaseBoard(fen.split()[0])))
+
+
+def get_moves_to(board, target):
+    """ like get_moves(), for a placement_key() instead of a FEN """
+    if placement_key(board) == target:
         logging.debug('Positions identical')
         return []
+    # only moves touching the changed squares can explain the difference
+    diff = placement_diff(placement_key(board), target)
     copy_board = board.copy()  # type: chess.Board
-    moves = list(board.generate_legal_moves())
+    moves = list(board.generate_legal_moves(from_mask=diff))
     for move in moves:
+        if move_squares(board, move) != diff:
+            continue
         copy_board.push(move)
-        if board_fen == copy_board.board_fen():
-            logging.debug('Single move detected - {}'.format(move.uci()))
+        if target == placement_key(copy_board):
+            logging.debug('Single move detected - %s', move)
             return [move.uci()]
         copy_board.pop()
     for move in moves:
+        squares = move_squares(board, move)
         copy_board.push(move)
-        legal_moves2 = list(copy_board.generate_legal_moves())
+        # the reply may also land on (and restore) the square the first move went to
+        legal_moves2 = list(copy_board.generate_legal_moves(from_mask=diff, to_mask=diff | chess.BB_SQUARES[move.to_square]))
         for move2 in legal_moves2:
+            squares2 = move_squares(copy_board, move2)
+            # squares touched by one move only must have changed, all changed squares must be touched
+            if squares & ~diff & ~squares2 or squares2 & ~(diff | squares) or diff & ~(squares | squares2):
+                continue
             copy_board.push(move2)
-            if board_fen == copy_board.board_fen():
-                logging.debug('Double move detected - {}, {}'.format(move.uci(), move2.uci()))
+            if target == placement_key(copy_board):
+                logging.debug('Double move detected - %s, %s', move, move2)
                 return [move.uci(), move2.uci()]
             copy_board.pop()
         copy_board.pop()
@@ -1,35 +1,55 @@
 import os
 import platform
-import appdirs
 
 
 ENGINE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), "engines")
 BOOK_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), "books")
 BASE_PORT = 3102
 
-if platform.system() == "Windows":
-    import ctypes.wintypes
+MAX_DEPTH_DEFAULT = 20
+MATCH_RADIUS_DEFAULT = 4
 
-    CSIDL_PERSONAL = 5  # My Documents
-    SHGFP_TYPE_CURRENT = 0  # Get current, not default value
 
-    buf = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
-    ctypes.windll.shell32.SHGetFolderPathW(
-        None, CSIDL_PERSONAL, None, SHGFP_TYPE_CURRENT, buf
-    )
+def my_documents():
+    if platform.system() == "Windows":
+        import ctypes.wintypes
 
-    MY_DOCUMENTS = buf.value
-else:
-    MY_DOCUMENTS = os.path.expanduser("~/Documents")
+        CSIDL_PERSONAL = 5  # My Documents
+        SHGFP_TYPE_CURRENT = 0  # Get current, not default value
 
+        buf = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
+        ctypes.windll.shell32.SHGetFolderPathW(
+            None, CSIDL_PERSONAL, None, SHGFP_TYPE_CURRENT, buf
+        )
 
-CERTABO_SAVE_PATH = os.path.join(MY_DOCUMENTS, "Certabo Saved Games")
-CERTABO_DATA_PATH = appdirs.user_data_dir("GUI", "Certabo")
+        return buf.value
+    return os.path.expanduser("~/Documents")
+
+
+def certabo_data_path():
+    import appdirs
+
+    return appdirs.user_data_dir("GUI", "Certabo")
+
+
+# the paths below are looked up on first use, not at import
+lazy_constants = {
+    "MY_DOCUMENTS": my_documents,
+    "CERTABO_SAVE_PATH": lambda: os.path.join(__getattr__("MY_DOCUMENTS"), "Certabo Saved Games"),
+    "CERTABO_DATA_PATH": certabo_data_path,
+}
+
+
+def __getattr__(name):
+    if name not in lazy_constants:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = lazy_constants[name]()
+    globals()[name] = value
+    return value
 
-MAX_DEPTH_DEFAULT = 20
 
 if __name__ == "__main__":
     print("ENGINE_PATH", ENGINE_PATH)
-    print("MY_DOCUMENTS", MY_DOCUMENTS)
-    print("CERTABO_DATA_PATH", CERTABO_DATA_PATH)
-    print("CERTABO_SAVE_PATH", CERTABO_SAVE_PATH)
+    print("MY_DOCUMENTS", __getattr__("MY_DOCUMENTS"))
+    print("CERTABO_DATA_PATH", __getattr__("CERTABO_DATA_PATH"))
+    print("CERTABO_SAVE_PATH", __getattr__("CERTABO_SAVE_PATH"))
@@ -0,0 +1,108 @@
+#
+# latency statistics of the path from the board's serial data to bestmove
+#
+
+import json
+import math
+import platform
+import time
+
+# stages a frame passes, in order
+STAGES = (
+    "read",      # bytes available on the port -> frame parsed
+    "queue",     # frame parsed -> taken by the main loop
+    "filter",    # noise filter
+    "decode",    # sensor codes -> piece placement
+    "detect",    # placement -> moves
+    "output",    # bestmove written and flushed
+    "frame",     # bytes available -> frame handled
+    "bestmove",  # bytes available -> bestmove flushed, for frames that completed a move
+)
+
+
+class LatencyHistogram:
+    """
+    Durations in log scaled buckets, `resolution` buckets per doubling
+    starting at 1us, so recording costs the same however many were recorded.
+    """
+
+    base = 1e-6
+
+    def __init__(self, resolution=8, buckets=200):
+        self.resolution = resolution
+        self.counts = [0] * buckets
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds > self.base:
+            bucket = min(int(math.log2(seconds / self.base) * self.resolution) + 1, len(self.counts) - 1)
+        else:
+            bucket = 0
+        self.counts[bucket] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """ upper bound of the bucket holding the given fraction of the durations, in seconds """
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self.base * 2 ** (bucket / self.resolution), self.max)
+        return self.max
+
+
+class LatencyStats:
+    """ one LatencyHistogram per stage """
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds)
+
+    def summary(self):
+        """ {stage: {"count", "p50", "p95", "p99", "max"}} in milliseconds for the stages seen so far """
+        result = {}
+        for stage in STAGES:
+            histogram = self.histograms[stage]
+            if not histogram.count:
+                continue
+            result[stage] = {"count": histogram.count}
+            for percentile in self.percentiles:
+                result[stage][f"p{percentile}"] = round(histogram.percentile(percentile / 100) * 1000, 3)
+            result[stage]["max"] = round(histogram.max * 1000, 3)
+        return result
+
+    def report_lines(self):
+        lines = []
+        for stage, values in self.summary().items():
+            lines.append(
+                f"latency {stage} n={values['count']} p50={values['p50']}ms p95={values['p95']}ms "
+                f"p99={values['p99']}ms max={values['max']}ms"
+            )
+        return lines or ["latency no frames yet"]
+
+    def write(self, path):
+        """ write the summary as JSON, along with the host it was measured on """
+        data = {
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "since": self.started,
+            "written": time.time(),
+            "stages": self.summary(),
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
@@ -0,0 +1,146 @@
+#
+# LED output to the board
+#
+
+import heapq
+import itertools
+import threading
+import time
+
+leds_off = b'\x00' * 8
+
+
+class LedOutput:
+    """
+    Last stage before the serial port: remembers the LED state it sent and
+    drops writes that would not change the LEDs.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.last = None
+        self.skipped = 0
+
+    def show(self, message=leds_off):
+        """ send an 8 byte LED message unless it is already showing, returns True if sent """
+        message = bytes(message)
+        if message == self.last:
+            self.skipped += 1
+            return False
+        self.last = message
+        self.send(message)
+        return True
+
+    def invalidate(self):
+        """ forget the LED state, e.g. after reconnecting to the board """
+        self.last = None
+
+
+class Animation:
+    """ (message, seconds) pairs played by a LedAnimator, see LedAnimator.play() """
+
+    def __init__(self, frames, repeat=False):
+        self.frames = [(bytes(message), duration) for message, duration in frames]
+        self.repeat = repeat
+        self.position = 0
+        self.cancelled = False
+
+
+class LedAnimator:
+    """
+    Timer driven LED animations in front of a LedOutput. The animations
+    playing are kept in a heap ordered by the time their next message is
+    due. run_due() shows what is due and returns when to call it again, the
+    main loop calls it from a timer; wakeup() is called when an animation is
+    started, so that the timer can be moved earlier.
+
+    Real output through show() pre-empts all animations, except for all LEDs
+    off, which is held back and shown when the animations are done.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, output, wakeup=None, clock=time.monotonic):
+        self.output = output
+        self.wakeup = wakeup
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.pending = []  # heap of (due, sequence number, animation)
+        self.sequence = itertools.count()
+        self.playing = set()
+        self.base = leds_off
+
+    def play(self, frames, repeat=False):
+        """ start playing (message, seconds) pairs, returns the Animation for cancel() """
+        animation = Animation(frames, repeat)
+        if repeat and sum(duration for _, duration in animation.frames) <= 0:
+            raise ValueError("a repeating animation needs a duration")
+        with self.lock:
+            self.playing.add(animation)
+            heapq.heappush(self.pending, (self.clock(), next(self.sequence), animation))
+        if self.wakeup is not None:
+            self.wakeup()
+        return animation
+
+    def cancel(self, animation=None):
+        """ stop an animation, or all of them, and show the real LED state again """
+        with self.lock:
+            if animation is None:
+                stopped = list(self.playing)
+            elif animation in self.playing:
+                stopped = [animation]
+            else:
+                return
+            for animation in stopped:
+                self.finish(animation)
+
+    def finish(self, animation):
+        # its heap entry is dropped when it comes up
+        animation.cancelled = True
+        self.playing.discard(animation)
+        if not self.playing:
+            self.pending.clear()
+            self.output.show(self.base)
+
+    def show(self, message=leds_off):
+        """ real LED output, returns True if it was sent """
+        message = bytes(message)
+        with self.lock:
+            self.base = message
+            if self.playing:
+                if message == leds_off:
+                    return False
+                for animation in self.playing:
+                    animation.cancelled = True
+                self.playing.clear()
+                self.pending.clear()
+            return self.output.show(message)
+
+    def next_due(self):
+        """ clock() time the next message is due at, None if nothing plays """
+        with self.lock:
+            while self.pending and self.pending[0][2].cancelled:
+                heapq.heappop(self.pending)
+            return self.pending[0][0] if self.pending else None
+
+    def run_due(self):
+        """ show the messages that are due, returns next_due() """
+        with self.lock:
+            now = self.clock()
+            while self.pending and self.pending[0][0] <= now:
+                due, _, animation = heapq.heappop(self.pending)
+                if animation.cancelled:
+                    continue
+                if animation.position == len(animation.frames):
+                    if not animation.repeat:
+                        self.finish(animation)
+                        continue
+                    animation.position = 0
+                message, duration = animation.frames[animation.position]
+                animation.position += 1
+                self.output.show(message)
+                due += duration
+                if duration and due <= now:
+                    # the timer ran late, keep the pace instead of catching up
+                    due = now + duration
+                heapq.heappush(self.pending, (due, next(self.sequence), animation))
+            return self.next_due()
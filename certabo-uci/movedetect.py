@@ -0,0 +1,196 @@
+#
+# move recognition: which moves lead from the virtual board to what the sensors see
+#
+
+import collections
+import logging
+import os
+import struct
+import threading
+
+import chess
+import chess.polyglot
+
+import codes
+
+
+def position_key(board):
+    """ everything about a chess.Board that decides its legal moves """
+    return codes.placement_key(board), board.turn, board.castling_rights, board.ep_square
+
+
+class SuccessorIndex:
+    """
+    Maps the piece placement (codes.placement_key) of every position one or
+    two plies after `board` to the moves leading there, the same moves
+    codes.get_moves() would find. Built in a background thread, until it is
+    ready lookups fall back to codes.get_moves().
+    """
+
+    def __init__(self, board):
+        self.board = board.copy(stack=False)
+        self.key = position_key(board)
+        self.successors = {}
+        self.cancelled = False
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.build, name="successors", daemon=True)
+        self.thread.start()
+
+    def build(self):
+        board = self.board
+        successors = {codes.placement_key(board): []}
+        first_moves = list(board.generate_legal_moves())
+        # single moves take precedence over double moves, like in codes.get_moves()
+        for move in first_moves:
+            board.push(move)
+            successors.setdefault(codes.placement_key(board), [move.uci()])
+            board.pop()
+        for move in first_moves:
+            if self.cancelled:
+                return
+            board.push(move)
+            for move2 in board.generate_legal_moves():
+                board.push(move2)
+                successors.setdefault(codes.placement_key(board), [move.uci(), move2.uci()])
+                board.pop()
+            board.pop()
+        self.successors = successors
+        self.ready.set()
+        logging.debug('successor index ready, %s placements', len(successors))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def covers(self, board):
+        return self.ready.is_set() and self.key == position_key(board)
+
+    def lookup(self, placement):
+        """ moves leading to placement, raises codes.InvalidMove if there are none """
+        moves = self.successors.get(placement)
+        if moves is None:
+            raise codes.InvalidMove()
+        return moves
+
+
+class MoveMemo:
+    """
+    LRU bounded memo of (position, observed placement) -> moves recognised
+    there, kept across sessions in a file. The file is read on first use and
+    written by save().
+
+    File format: "CMM1", entry count (uint32), then per entry, least
+    recently used first, the position's polyglot zobrist key, the 8
+    placement bitboards (little endian uint64 each), the number of moves
+    (uint8) and every move as uint16 (from | to << 6 | promotion << 12).
+    """
+
+    magic = b"CMM1"
+    entry_header = struct.Struct("<9QB")
+
+    def __init__(self, path, size=4096):
+        self.path = path
+        self.size = size
+        self.entries = None
+        self.positions = collections.Counter()  # zobrist key -> number of entries
+        self.dirty = False
+        # zobrist_hash() is slow, the key of the last position asked for is kept
+        self.last_position = None
+        self.last_zobrist = None
+
+    def load(self):
+        self.entries = collections.OrderedDict()
+        self.positions.clear()
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return
+        try:
+            if data[:4] != self.magic:
+                raise ValueError("bad magic")
+            count, = struct.unpack_from("<I", data, 4)
+            offset = 8
+            for _ in range(count):
+                values = self.entry_header.unpack_from(data, offset)
+                offset += self.entry_header.size
+                n_moves = values[9]
+                packed = struct.unpack_from(f"<{n_moves}H", data, offset)
+                offset += 2 * n_moves
+                moves = [chess.Move(p & 63, (p >> 6) & 63, (p >> 12) or None).uci() for p in packed]
+                self.entries[(values[0], values[1:9])] = moves
+        except (ValueError, struct.error) as e:
+            logging.info(f'Ignoring broken move memo {self.path}: {str(e)}')
+            self.entries.clear()
+        self.positions.update(zobrist for zobrist, _ in self.entries)
+        logging.debug('loaded %s memorised moves', len(self.entries))
+
+    def save(self):
+        if not self.dirty:
+            return
+        chunks = [self.magic, struct.pack("<I", len(self.entries))]
+        for (zobrist, placement), moves in self.entries.items():
+            chunks.append(self.entry_header.pack(zobrist, *placement, len(moves)))
+            for uci in moves:
+                move = chess.Move.from_uci(uci)
+                chunks.append(struct.pack("<H", move.from_square | move.to_square << 6 | (move.promotion or 0) << 12))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(chunks))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def zobrist(self, board):
+        position = position_key(board)
+        if position != self.last_position:
+            self.last_position = position
+            self.last_zobrist = chess.polyglot.zobrist_hash(board)
+        return self.last_zobrist
+
+    def knows(self, board):
+        """ True if moves were memorised for board """
+        if self.entries is None:
+            self.load()
+        return self.zobrist(board) in self.positions
+
+    def get(self, board, placement):
+        """ memorised moves from board to placement, None if unknown """
+        if self.entries is None:
+            self.load()
+        key = (self.zobrist(board), placement)
+        moves = self.entries.get(key)
+        if moves is not None:
+            self.entries.move_to_end(key)
+        return moves
+
+    def put(self, board, placement, moves):
+        if self.entries is None:
+            self.load()
+        key = (self.zobrist(board), placement)
+        if key not in self.entries:
+            self.positions[key[0]] += 1
+        self.entries[key] = moves
+        if len(self.entries) > self.size:
+            (zobrist, _), _ = self.entries.popitem(last=False)
+            self.positions[zobrist] -= 1
+            if not self.positions[zobrist]:
+                del self.positions[zobrist]
+        self.dirty = True
+
+
+def find_moves(index, board, placement, memo=None):
+    """
+    Like codes.get_moves_to(board, placement), answered from the memo if
+    given, else from the successor index when it is ready and belongs to
+    board. Moves found are memorised.
+    """
+    if memo is not None:
+        moves = memo.get(board, placement)
+        if moves is not None:
+            return moves
+    if index is not None and index.covers(board):
+        moves = index.lookup(placement)
+    else:
+        moves = codes.get_moves_to(board, placement)
+    if memo is not None:
+        memo.put(board, placement, moves)
+    return moves
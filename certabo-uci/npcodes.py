@@ -0,0 +1,67 @@
+#
+# optional NumPy version of the calibration vote, codes.py is the reference
+# implementation and the fallback when numpy is not installed
+#
+# The engine decodes frames with codes.DeltaDecoder, which only looks at the
+# cells that changed and is faster than a whole-frame decode for that.
+#
+
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+available = np is not None
+
+
+def frame_array(usb_data):
+    """ return a frame (320 values, list or bytes) as a (64, 5) uint8 array """
+    if isinstance(usb_data, (bytes, bytearray, memoryview)):
+        data = np.frombuffer(usb_data, dtype=np.uint8)
+    else:
+        data = np.asarray(usb_data, dtype=np.uint8)
+    return data.reshape(64, 5)
+
+
+def pack_codes(cells):
+    """ pack (..., 5) uint8 cell codes into 40-bit integers """
+    cells = np.asarray(cells, dtype=np.uint8)
+    padded = np.zeros(cells.shape[:-1] + (8,), dtype=np.uint8)
+    padded[..., 3:] = cells
+    return padded.view(">u8")[..., 0].astype(np.uint64)
+
+
+def frames_array(samples):
+    """ return a stack of frames as a (samples, 64, 5) uint8 array """
+    if isinstance(samples, np.ndarray):
+        return samples.astype(np.uint8, copy=False).reshape(-1, 64, 5)
+    return np.stack([frame_array(usb_data) for usb_data in samples])
+
+
+def unpack_codes(packed):
+    """ inverse of pack_codes(), returns (..., 5) uint8 cell codes """
+    return packed.astype(">u8").view(np.uint8).reshape(packed.shape + (8,))[..., 3:]
+
+
+def cell_modes(packed, candidates):
+    """
+    For every cell (column) pick the candidate code seen most often among the
+    packed samples of that cell, the first candidate wins a tie.
+    """
+    n_samples, n_cells = packed.shape
+    # offsetting each column by its cell number lets one sorted array hold all 64 histograms
+    offsets = np.arange(n_cells, dtype=np.uint64) << np.uint64(40)
+    observed = np.sort((packed + offsets).ravel())
+    wanted = candidates + offsets
+    counts = np.searchsorted(observed, wanted, "right") - np.searchsorted(observed, wanted, "left")
+    return candidates[counts.argmax(axis=0), np.arange(n_cells)]
+
+
+def statistic_processing_for_calibration(samples, show_print):
+    packed = pack_codes(frames_array(samples))
+    result = unpack_codes(cell_modes(packed, packed)).ravel().tolist()
+    if show_print:
+        logging.info("---final code: %s", " ".join(map(str, result)))
+    return result
@@ -0,0 +1,113 @@
+#
+# on demand profiling of the running engine, see the Profile UCI option
+#
+# While running, a thread samples the stacks of all other threads from
+# sys._current_frames() and tracemalloc traces allocations. Nothing of it
+# is active while the profiler is stopped.
+#
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler over all threads. stop() writes the sampled stacks
+    in the folded format of flamegraph.pl, a summary of the functions seen
+    most and the allocations made since start().
+    """
+
+    def __init__(self, interval=0.005, memory_frames=10):
+        self.interval = interval
+        self.memory_frames = memory_frames
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = time.time()
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start(self.memory_frames)
+        self.baseline = tracemalloc.take_snapshot()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+        logging.info("profiler started")
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self, directory):
+        """ stop profiling and write the reports to directory, returns their paths """
+        if not self.running:
+            return []
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        snapshot = tracemalloc.take_snapshot()
+        self.traced = tracemalloc.get_traced_memory()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        logging.info(f"profiler stopped after {self.samples} samples")
+
+        prefix = os.path.join(directory, time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(self.started)))
+        folded = prefix + ".folded"
+        with open(folded, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+        summary = prefix + ".txt"
+        with open(summary, "w") as f:
+            self.write_summary(f, snapshot)
+        return [summary, folded]
+
+    def write_summary(self, f, snapshot, limit=30):
+        duration = time.time() - self.started
+        f.write(f"{self.samples} samples every {self.interval * 1000:g}ms over {duration:.1f}s\n")
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            # the thread name comes first, the running function last
+            own[(stack[0], stack[-1])] += count
+            for name in set(stack[1:]):
+                total[(stack[0], name)] += count
+        f.write("\nfunctions running most, waiting in them included (thread, samples, share of samples)\n")
+        for (thread, name), count in own.most_common(limit):
+            f.write(f"  {thread:20} {name:50} {count:7} {count / max(self.samples, 1):7.1%}\n")
+        f.write("\nfunctions on the stack most, including callees\n")
+        for (thread, name), count in total.most_common(limit):
+            f.write(f"  {thread:20} {name:50} {count:7} {count / max(self.samples, 1):7.1%}\n")
+        f.write("\nmemory allocated since start, by line\n")
+        for stat in snapshot.compare_to(self.baseline, "lineno")[:limit]:
+            f.write(f"  {stat}\n")
+        current, peak = self.traced
+        f.write(f"\ntraced memory {current} bytes, peak {peak} bytes\n")
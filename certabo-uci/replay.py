@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# replay a capture recorded with certabo-uci.py --record through a pseudo
+# terminal, standing in for the board
+#
+# python3 replay.py game.ccap --speed 2 --run
+#
+# prints the pty's path to stderr; with --run certabo-uci.py is started on
+# it, talking UCI on this process's stdin/stdout. With --run or --calibration
+# the engine keeps its files (calibration, log, memo) in a home directory of
+# its own, a temporary one unless --data-dir is given; without --run the
+# HOME and XDG_DATA_HOME to start the engine with are printed.
+#
+
+import argparse
+import os
+import pty
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tty
+
+import capture
+
+
+def drain(fd):
+    """ read and drop what was written to the board, e.g. LED output """
+    while select.select([fd], [], [], 0)[0]:
+        try:
+            if not os.read(fd, 4096):
+                return
+        except OSError:
+            return
+
+
+def replay(path, fd, speed=1.0, loops=1):
+    """ write the frames of a capture to fd, speed 0 sends them as fast as they are taken """
+    frames = 0
+    started = time.monotonic()
+    for _ in range(loops):
+        loop_started = time.monotonic()
+        for elapsed, frame in capture.read_capture(path):
+            if speed:
+                delay = loop_started + elapsed / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            os.write(fd, capture.frame_line(frame))
+            frames += 1
+            drain(fd)
+    return frames, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a board capture through a pseudo terminal")
+    parser.add_argument("capture", help="file written by certabo-uci.py --record")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed, 2 is twice as fast as recorded, 0 as fast as possible")
+    parser.add_argument("--loops", type=int, default=1, help="replay the capture this many times")
+    parser.add_argument("--run", action="store_true", help="start certabo-uci.py on the pty")
+    parser.add_argument("--calibration", metavar="FILE",
+                        help="calibration file of the recorded board, installed for the pty")
+    parser.add_argument("--data-dir", metavar="DIR",
+                        help="home directory for the engine with --run or --calibration, kept afterwards")
+    parser.add_argument("--wait", type=float, default=1.0, help="seconds to wait before the first frame")
+    args, engine_args = parser.parse_known_args()
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+    print(f"replaying {args.capture} on {port}", file=sys.stderr)
+    temporary = None
+    if args.run or args.calibration is not None:
+        # pty numbers map to the same calibration files as real ports, e.g.
+        # /dev/pts/0 to COM1's, so the engine must not see the user's data
+        if args.data_dir is None:
+            temporary = tempfile.TemporaryDirectory(prefix="certabo-replay-")
+        home = os.path.abspath(args.data_dir or temporary.name)
+        # inherited by the engine, and read by constants on first use
+        os.environ["HOME"] = home
+        os.environ["XDG_DATA_HOME"] = os.path.join(home, ".local", "share")
+        if not args.run:
+            print(f"start the engine with HOME={home} XDG_DATA_HOME={os.environ['XDG_DATA_HOME']}", file=sys.stderr)
+    if args.calibration is not None:
+        # the engine looks for the calibration by port number, the .cal file
+        # first, then the old .bin one
+        from constants import CERTABO_DATA_PATH
+        from codes import get_calibration_file_name
+        from utils import port2number
+        number = port2number(port)
+        for extension in ("cal", "bin"):
+            existing = os.path.join(CERTABO_DATA_PATH, get_calibration_file_name(number, extension))
+            if os.path.exists(existing):
+                parser.error(f"not overwriting the existing calibration {existing}")
+        target = os.path.join(CERTABO_DATA_PATH, get_calibration_file_name(number))
+        os.makedirs(CERTABO_DATA_PATH, exist_ok=True)
+        shutil.copyfile(args.calibration, target)
+    engine = None
+    if args.run:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "certabo-uci.py")
+        engine = subprocess.Popen([sys.executable, script, "--port", port] + engine_args)
+    try:
+        time.sleep(args.wait)
+        frames, duration = replay(args.capture, master, args.speed, args.loops)
+        print(f"sent {frames} frames in {duration:.2f}s, {frames / max(duration, 1e-9):.1f} frames/s", file=sys.stderr)
+        if engine is not None:
+            engine.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if engine is not None and engine.poll() is None:
+            engine.terminate()
+        os.close(master)
+        os.close(slave)
+        if temporary is not None:
+            temporary.cleanup()
+
+
+if __name__ == "__main__":
+    main()
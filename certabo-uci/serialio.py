@@ -0,0 +1,218 @@
+#
+# serial link to the board
+#
+# The board sends one line per scan: a start character, 320 space separated
+# decimal values (64 cells * 5 code bytes, cell 0 at the top left) and three
+# trailing characters ending with the newline.
+#
+
+import collections
+import logging
+import os
+import select
+import threading
+import time
+
+FRAME_VALUES = 320  # 64*5
+
+# decimal token -> value, a dict probe is much cheaper than int() per token
+token_values = {b"%d" % value: value for value in range(256)}
+
+
+def parse_frame(line):
+    """ convert a complete line (bytes) from the board to 320 values, None if it is malformed """
+    tokens = line[1:-3].split(b" ")
+    if len(tokens) != FRAME_VALUES:
+        return None
+    try:
+        return bytes(map(token_values.__getitem__, tokens))
+    except KeyError:
+        return None
+
+
+class FrameReader:
+    """
+    Splits the byte stream from the board into frames. Data is received into a
+    preallocated buffer and parsed straight from it, partial lines stay in the
+    buffer until the rest arrives.
+    """
+
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.malformed = 0  # lines that were no frame, reported by the engine
+
+    def reset(self):
+        self.length = 0
+
+    def read_fd(self, fd):
+        """ read what is available on the (non-blocking) fd, return the frames completed by it """
+        try:
+            size = os.readv(fd, [self.view[self.length:]])
+        except BlockingIOError:
+            return []
+        if not size:
+            raise EOFError("serial port closed")
+        self.length += size
+        return self.frames()
+
+    def frames(self):
+        frames = []
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", start, self.length)
+            if end < 0:
+                break
+            frame = parse_frame(bytes(self.view[start:end + 1]))
+            if frame is not None:
+                frames.append(frame)
+            elif end - start > 1:
+                self.malformed += 1
+            start = end + 1
+        if start:
+            remaining = self.length - start
+            self.buffer[:remaining] = self.buffer[start:self.length]
+            self.length = remaining
+        elif self.length == len(self.buffer):
+            logging.info("Discarding %d bytes of serial data without a line end", self.length)
+            self.malformed += 1
+            self.length = 0
+        return frames
+
+
+class FrameChannel:
+    """
+    Bounded hand-over of frames from the serial side to the consumer. Only
+    the newest `maxlen` frames are kept, older ones are dropped and counted so
+    a consumer that fell behind continues with the current board state.
+    """
+
+    def __init__(self, maxlen=1):
+        self.maxlen = maxlen
+        self.frames = collections.deque()
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def put(self, frame):
+        with self.lock:
+            if len(self.frames) >= self.maxlen:
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append(frame)
+
+    def get(self):
+        """ return the oldest kept frame, None if there is none """
+        with self.lock:
+            if self.frames:
+                return self.frames.popleft()
+        return None
+
+
+class SerialTransport:
+    """
+    Event driven serial link: poll() sleeps until the board sends data or
+    output is queued with send(), which wakes it through a pipe. Complete
+    frames are passed to on_frame(frame, received), all queued output is
+    written at once.
+    An event loop can instead watch fd and wake_r itself and call receive(),
+    drain_wake() and flush().
+
+    Works on anything with a fileno(), e.g. a serial.Serial or one end of a
+    pty pair standing in for the board.
+    """
+
+    def __init__(self, on_frame):
+        self.on_frame = on_frame
+        self.reader = FrameReader()
+        self.outgoing = collections.deque()
+        self.uart = None
+        self.fd = None
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.poller = select.poll()
+        self.poller.register(self.wake_r, select.POLLIN)
+
+    def attach(self, uart):
+        """ start using an open port, output queued meanwhile is kept """
+        self.detach()
+        self.uart = uart
+        self.fd = uart.fileno()
+        os.set_blocking(self.fd, False)
+        self.reader.reset()
+        self.poller.register(self.fd, select.POLLIN)
+        self.wake()
+
+    def detach(self):
+        """ stop using the port and close it """
+        if self.fd is None:
+            return
+        self.poller.unregister(self.fd)
+        try:
+            self.uart.close()
+        except Exception as e:
+            logging.info(f'Error closing serial port: {str(e)}')
+        self.uart = None
+        self.fd = None
+
+    def send(self, data):
+        """ queue data for the board, safe to call from any thread """
+        self.outgoing.append(bytes(data))
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b"\0")
+        except BlockingIOError:
+            pass  # pipe is full, so a wake up is pending anyway
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds for data from the board or queued output and
+        handle both. Raises OSError or EOFError when the port fails.
+        """
+        events = self.poller.poll(None if timeout is None else timeout * 1000)
+        for fd, event in events:
+            if fd == self.wake_r:
+                self.drain_wake()
+            elif fd == self.fd:
+                if event & select.POLLIN:
+                    self.receive()
+                elif event & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                    raise EOFError("serial port hung up")
+        if not self.flush():
+            self.poller.modify(self.fd, select.POLLIN | select.POLLOUT)
+        elif self.fd is not None:
+            self.poller.modify(self.fd, select.POLLIN)
+
+    def receive(self):
+        """ read what the board sent and pass on the complete frames along with the time.monotonic() of the read """
+        received = time.monotonic()
+        for frame in self.reader.read_fd(self.fd):
+            self.on_frame(frame, received)
+
+    def drain_wake(self):
+        while True:
+            try:
+                if not os.read(self.wake_r, 512):
+                    break
+            except BlockingIOError:
+                break
+
+    def flush(self):
+        """ write queued output, returns False if the port can't take all of it right now """
+        if self.fd is None:
+            return True
+        while self.outgoing:
+            data = self.outgoing[0]
+            logging.debug('Sending to serial: %s', data)
+            try:
+                written = os.write(self.fd, data)
+            except BlockingIOError:
+                written = 0
+            if written < len(data):
+                self.outgoing[0] = data[written:]
+                return False
+            self.outgoing.popleft()
+        return True
@@ -0,0 +1,109 @@
+#
+# synthetic sensor frames for benchmarks and replays without a board
+#
+
+import random
+
+import chess
+
+import codes
+
+
+class SensorProfile:
+    """
+    Piece codes of a board, as in the calibration lists of codes.py, used to
+    render the frame the board would send for a position. Every square shows
+    the same code for a piece type, so a piece keeps its code while it stays
+    on its square.
+    """
+
+    def __init__(self, lists):
+        self.lists = dict(zip(codes.calibration_pieces, lists))
+
+    @classmethod
+    def random(cls, seed=1, sets=1):
+        """ distinct codes for `sets` full sets of pieces """
+        rnd = random.Random(seed)
+        used = set()
+        lists = []
+        for name in codes.calibration_pieces:
+            count = sets * {"p": 8, "k": 1, "q": 1}.get(name.lower(), 2)
+            cells = []
+            while len(cells) < count:
+                cell = [rnd.randint(1, 255) for _ in range(5)]
+                if tuple(cell) not in used:
+                    used.add(tuple(cell))
+                    cells.append(cell)
+            lists.append(cells)
+        return cls(lists)
+
+    def install(self):
+        """ make this the calibration of codes.py, without saving it """
+        for name, cells in self.lists.items():
+            setattr(codes, name, [list(cell) for cell in cells])
+        codes.build_piece_index()
+
+    def code(self, piece, square):
+        cells = self.lists[piece.symbol()]
+        return cells[square % len(cells)]
+
+    def render(self, board, rnd=None, noise=0.0, bit_noise=0.0, rotate180=False):
+        """
+        320 values for a chess.BaseBoard. With probability `noise` a cell reads
+        a random code, with probability `bit_noise` one bit of its code flips.
+        """
+        squares = codes.CELL_SQUARE_ROTATED if rotate180 else codes.CELL_SQUARE
+        rnd = rnd or random
+        frame = []
+        for square in squares:
+            piece = board.piece_at(square)
+            cell = [0] * 5 if piece is None else list(self.code(piece, square))
+            if noise and rnd.random() < noise:
+                cell = [rnd.randint(1, 255) for _ in range(5)]
+            elif bit_noise and piece is not None and rnd.random() < bit_noise:
+                bit = rnd.randrange(40)
+                cell[bit // 8] ^= 1 << (bit % 8)
+            frame += cell
+        return frame
+
+
+def random_game(seed=1, max_plies=80):
+    """ moves of a random legal game """
+    rnd = random.Random(seed)
+    board = chess.Board()
+    moves = []
+    while len(moves) < max_plies and not board.is_game_over():
+        move = rnd.choice(list(board.legal_moves))
+        board.push(move)
+        moves.append(move)
+    return moves
+
+
+def game_frames(profile, moves, board=None, frames_per_state=3, lift_frames=1, rnd=None, noise=0.0, bit_noise=0.0):
+    """
+    Frames of a game played on the board: for every move the moving piece,
+    and a captured one, is lifted for `lift_frames` frames, then the new
+    position is shown for `frames_per_state` frames. Yields (frame, move),
+    move being the move whose final position the frame shows first, else
+    None.
+    """
+    board = chess.Board() if board is None else board.copy()
+    rnd = rnd or random.Random(1)
+
+    def render(position):
+        return profile.render(position, rnd, noise, bit_noise)
+
+    for _ in range(frames_per_state):
+        yield render(board), None
+    for move in moves:
+        lifted = chess.BaseBoard(board.board_fen())
+        lifted.remove_piece_at(move.from_square)
+        if board.is_en_passant(move):
+            lifted.remove_piece_at(chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square)))
+        elif board.is_capture(move):
+            lifted.remove_piece_at(move.to_square)
+        for _ in range(lift_frames):
+            yield render(lifted), None
+        board.push(move)
+        for n_frame in range(frames_per_state):
+            yield render(board), move if n_frame == 0 else None
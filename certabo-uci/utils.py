@@ -1,19 +1,12 @@
 import sys
 import logging
 import os
-import serial
 import string
 import platform
 import stat
 from constants import BASE_PORT, ENGINE_PATH, BOOK_PATH
 
 
-if os.name == 'nt':  # sys.platform == 'win32':
-    from serial.tools.list_ports_windows import comports
-elif os.name == 'posix':
-    from serial.tools.list_ports_posix import comports
-
-
 def port2number(port):
     if isinstance(port, str):
         try:
@@ -45,13 +38,19 @@ def port2udp(port_number):
 
 
 def find_port():
+    # pyserial is only needed here, not importing it at startup makes that faster
+    import serial
+    if os.name == 'nt':  # sys.platform == 'win32':
+        from serial.tools.list_ports_windows import comports
+    elif os.name == 'posix':
+        from serial.tools.list_ports_posix import comports
     logging.debug('Searching for port...')
     for port in comports():
         device = port[0]
         if 'bluetooth' in device.lower():
             continue
         if port.pid != 0xea60 and port.vid != 0x10c4:
-            logging.debug(f'skipping: {port.hwid}')
+            logging.debug('skipping: %s', port.hwid)
             continue
         try:
             logging.debug('Trying %s', device)